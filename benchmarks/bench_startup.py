@@ -0,0 +1,78 @@
+"""
+插件启动性能基准测试
+
+测量插件模块导入耗时、插件构造耗时以及首次命令（cf 状态）的响应延迟。
+导入耗时在全新的子进程中测量，避免模块缓存影响结果。
+
+用法（需在已安装AstrBot的环境中运行）:
+    python benchmarks/bench_startup.py [-n 次数]
+"""
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+PLUGIN_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PLUGIN_PACKAGE = os.path.basename(PLUGIN_DIR)
+PLUGINS_ROOT = os.path.dirname(PLUGIN_DIR)
+
+# 在子进程中执行：导入插件主模块、构造插件并执行一次状态命令
+_PROBE_SCRIPT = """
+import sys, json, time, asyncio, importlib
+sys.path.insert(0, {root!r})
+
+t0 = time.perf_counter()
+main = importlib.import_module({package!r} + '.main')
+t1 = time.perf_counter()
+
+
+class _Event:
+    message_str = ''
+
+    def plain_result(self, text):
+        return text
+
+
+plugin = main.CloudflareIPOptimizerPlugin(None, {{}})
+t2 = time.perf_counter()
+
+
+async def _first_command():
+    async for _ in plugin.check_status(_Event()):
+        pass
+
+asyncio.run(_first_command())
+t3 = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (t1 - t0) * 1000,
+    'construct_ms': (t2 - t1) * 1000,
+    'first_command_ms': (t3 - t2) * 1000,
+    'heavy_modules': [m for m in ('aiohttp', 'pandas') if m in sys.modules],
+}}))
+"""
+
+
+def run_once() -> dict:
+    """在全新解释器中测量一次启动耗时"""
+    script = _PROBE_SCRIPT.format(root=PLUGINS_ROOT, package=PLUGIN_PACKAGE)
+    output = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, check=True).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='插件启动性能基准测试')
+    parser.add_argument('-n', '--runs', type=int, default=5, help='测量次数（取中位数）')
+    args = parser.parse_args()
+
+    samples = [run_once() for _ in range(args.runs)]
+    print(f"插件: {PLUGIN_PACKAGE}, 测量次数: {args.runs}")
+    for key, label in (('import_ms', '模块导入'), ('construct_ms', '插件构造'), ('first_command_ms', '首次命令')):
+        values = [sample[key] for sample in samples]
+        print(f"{label}: 中位数 {statistics.median(values):.1f}ms, 最大 {max(values):.1f}ms")
+    print(f"启动后已加载的重量级模块: {samples[-1]['heavy_modules'] or '无'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -1,8 +1,14 @@
 import os
+import csv
+import time
+import random
 import asyncio
 import aiohttp
+from email.utils import parsedate_to_datetime
 from astrbot.api import logger
-from typing import Dict, Optional
+from typing import Any, Dict, Optional
+
+from .tracing import span, start_span, traced
 
 # 默认配置
 DEFAULT_CONFIG = {
@@ -14,9 +20,226 @@ DEFAULT_CONFIG = {
     "interval": 300,
     "retry_count": 3,
     "result_file": "csft/result.csv",
-    "retry_interval": 5
+    "retry_interval": 5,
+    # Cloudflare API 配额: 每个Token 5分钟内1200次请求
+    "api_rate_limit": 1200,
+    "api_rate_window": 300,
+    "api_burst": 20,
+    "retry_max_interval": 60,
+    # DNS传播验证：解析器列表为空时不验证
+    "verify_resolvers": [],
+    "verify_timeout": 300,
+    "verify_interval": 5,
+    # 选择IP的指标：auto为有HTTPS延迟时按HTTPS延迟，否则按平均延迟；也可指定结果文件的列名（如P95延迟(ms)）
+    "selection_metric": "auto"
 }
 
+CLOUDFLARE_API_BASE = "https://api.cloudflare.com/client/v4"
+
+# 可以安全重试的幂等请求方法；POST（创建记录）在5xx或超时后重试可能产生重复记录
+IDEMPOTENT_METHODS = {"GET", "HEAD", "PUT", "DELETE"}
+
+
+class CloudflareAPIError(Exception):
+    """Cloudflare API请求错误"""
+
+    def __init__(self, message: str, status: int = 0, errors: Any = None, retryable: bool = False):
+        super().__init__(message)
+        self.status = status
+        self.errors = errors
+        self.retryable = retryable
+
+
+class TokenBucket:
+    """异步令牌桶限流器"""
+
+    def __init__(self, rate: float, capacity: float):
+        """
+        :param rate: 每秒补充的令牌数
+        :param capacity: 桶容量（允许的突发请求数）
+        """
+        self.rate = rate
+        self.capacity = capacity
+        self.waiting = 0
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def pause(self, seconds: float):
+        """在指定时间内暂停发放令牌（用于响应429/Retry-After）"""
+        self._blocked_until = max(self._blocked_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def acquire(self) -> float:
+        """获取一个令牌，返回排队等待的秒数"""
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            async with self._lock:
+                while True:
+                    blocked = self._blocked_until - time.monotonic()
+                    if blocked > 0:
+                        await asyncio.sleep(blocked)
+                        continue
+                    self._refill()
+                    if self._tokens >= 1:
+                        self._tokens -= 1
+                        break
+                    await asyncio.sleep((1 - self._tokens) / self.rate)
+        finally:
+            self.waiting -= 1
+        return time.monotonic() - start
+
+
+class CloudflareAPIScheduler:
+    """Cloudflare API请求调度器：令牌桶限流、Retry-After处理与抖动退避重试"""
+
+    def __init__(self, cf_token: str, rate_limit: int = 1200, rate_window: int = 300, burst: int = 20,
+                 max_attempts: int = 3, backoff_base: float = 5, backoff_max: float = 60):
+        self.cf_token = cf_token
+        self.bucket = TokenBucket(rate_limit / rate_window, burst)
+        self.max_attempts = max(1, max_attempts)
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.in_flight = 0
+        self.stats = {
+            "requests": 0,
+            "retries": 0,
+            "throttled": 0,
+            "failures": 0,
+            "total_wait": 0.0,
+            "max_wait": 0.0
+        }
+
+    @property
+    def headers(self) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {self.cf_token}",
+            "Content-Type": "application/json"
+        }
+
+    def _backoff(self, attempt: int) -> float:
+        """指数退避（全抖动）"""
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+
+    @staticmethod
+    def _parse_retry_after(value: Optional[str]) -> Optional[float]:
+        """解析Retry-After头，支持秒数和HTTP日期两种格式"""
+        if not value:
+            return None
+        try:
+            return max(0.0, float(value))
+        except ValueError:
+            pass
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取调度器统计信息（队列深度、等待时间等）"""
+        requests = self.stats["requests"]
+        return {
+            **self.stats,
+            "queue_depth": self.bucket.waiting,
+            "in_flight": self.in_flight,
+            "avg_wait": self.stats["total_wait"] / requests if requests else 0.0
+        }
+
+    async def request(self, method: str, url: str, **kwargs) -> Dict:
+        """
+        发送受限流保护的API请求
+        非幂等请求（如POST）只在429时重试：请求已被服务端拒绝，不会重复执行
+        :return: 解析后的JSON响应
+        :raises CloudflareAPIError: 请求最终失败时抛出
+        """
+        attempt = 0
+        idempotent = method.upper() in IDEMPOTENT_METHODS
+        while True:
+            with span('rate_limit_wait', queue_depth=self.bucket.waiting):
+                waited = await self.bucket.acquire()
+            self.stats["requests"] += 1
+            self.stats["total_wait"] += waited
+            self.stats["max_wait"] = max(self.stats["max_wait"], waited)
+            if waited > 1:
+                logger.info(f"API请求排队等待 {waited:.1f}秒，当前队列深度: {self.bucket.waiting}")
+
+            delay = None
+            self.in_flight += 1
+            request_span = start_span('cf_api_request', method=method, attempt=attempt + 1)
+            try:
+                async with aiohttp.ClientSession() as session:
+                    async with session.request(method, url, headers=self.headers,
+                                               timeout=aiohttp.ClientTimeout(total=10), **kwargs) as response:
+                        if request_span:
+                            request_span.set(status=response.status)
+                        if response.status == 429:
+                            self.stats["throttled"] += 1
+                            delay = self._parse_retry_after(response.headers.get("Retry-After"))
+                            if delay is None:
+                                delay = self._backoff(attempt)
+                            self.bucket.pause(delay)
+                            error = CloudflareAPIError("请求被限流(429)", status=429, retryable=True)
+                        elif response.status >= 500:
+                            error = CloudflareAPIError(f"服务端错误: HTTP {response.status}",
+                                                       status=response.status, retryable=idempotent)
+                        else:
+                            try:
+                                data = await response.json(content_type=None)
+                            except ValueError:
+                                data = {}
+                            if response.status >= 400:
+                                # 4xx校验类错误重试无意义，直接失败
+                                error = CloudflareAPIError(f"请求被拒绝: HTTP {response.status}", status=response.status,
+                                                           errors=data.get("errors") if isinstance(data, dict) else data)
+                            else:
+                                return data
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = CloudflareAPIError(f"网络请求失败: {e}", retryable=idempotent)
+            finally:
+                self.in_flight -= 1
+                if request_span:
+                    request_span.finish()
+
+            attempt += 1
+            if not error.retryable or attempt >= self.max_attempts:
+                self.stats["failures"] += 1
+                raise error
+            if delay is None:
+                delay = self._backoff(attempt)
+            self.stats["retries"] += 1
+            logger.warning(f"{error}，{delay:.1f}秒后进行第{attempt + 1}次尝试")
+            await asyncio.sleep(delay)
+
+
+# 按Token共享调度器，保证同一Token下的所有请求共用同一配额
+_schedulers: Dict[str, CloudflareAPIScheduler] = {}
+
+
+def get_api_scheduler(config: Dict) -> CloudflareAPIScheduler:
+    """获取（或创建）指定Token对应的API调度器"""
+    token = config["cf_token"]
+    scheduler = _schedulers.get(token)
+    if scheduler is None:
+        scheduler = CloudflareAPIScheduler(
+            token,
+            rate_limit=config["api_rate_limit"],
+            rate_window=config["api_rate_window"],
+            burst=config["api_burst"],
+            max_attempts=config["retry_count"],
+            backoff_base=config["retry_interval"],
+            backoff_max=config["retry_max_interval"]
+        )
+        _schedulers[token] = scheduler
+    return scheduler
+
+
 class CloudflareDDNSUpdater:
     """Cloudflare DDNS更新器"""
     
@@ -31,6 +254,10 @@ class CloudflareDDNSUpdater:
         self.retry_count = self.config["retry_count"]
         self.result_file = self.config["result_file"]
         self.retry_interval = self.config["retry_interval"]
+        self.api = get_api_scheduler(self.config)
+        self.verify_resolvers = self.config["verify_resolvers"]
+        self.last_ip = None
+        self.last_verification: Dict[str, Dict] = {}
         self.full_domain = f"{self.sub_domain}.{self.main_domain}" if self.sub_domain else self.main_domain
         
     def _validate_config(self, config: Dict) -> Dict:
@@ -57,37 +284,28 @@ class CloudflareDDNSUpdater:
         
         return merged_config
 
+    @traced('cf_get_record_id')
     async def _get_record_id(self) -> Optional[str]:
         """获取DNS记录ID（异步版本）"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records"
-        headers = {
-            "Authorization": f"Bearer {self.cf_token}",
-            "Content-Type": "application/json"
-        }
+        url = f"{CLOUDFLARE_API_BASE}/zones/{self.zone_id}/dns_records"
+        params = {"name": self.full_domain, "type": self.record_type}
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                    response.raise_for_status()
-                    data = await response.json()
-                    
-                    for record in data["result"]:
-                        if record["name"] == self.full_domain and record["type"] == self.record_type:
-                            return record["id"]
-                    
-                    logger.warning(f"未找到记录: {self.full_domain} ({self.record_type})")
-                    return None
-        except aiohttp.ClientError as e:
-            logger.error(f"获取记录ID失败: {str(e)}")
+            data = await self.api.request("GET", url, params=params)
+            for record in data.get("result") or []:
+                if record["name"] == self.full_domain and record["type"] == self.record_type:
+                    return record["id"]
+            
+            logger.warning(f"未找到记录: {self.full_domain} ({self.record_type})")
             return None
+        except CloudflareAPIError as e:
+            logger.error(f"获取记录ID失败: {str(e)}")
+            raise
 
+    @traced('cf_update_record')
     async def _update_dns_record(self, record_id: str, ip: str) -> bool:
         """更新DNS记录（异步版本）"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records/{record_id}"
-        headers = {
-            "Authorization": f"Bearer {self.cf_token}",
-            "Content-Type": "application/json"
-        }
+        url = f"{CLOUDFLARE_API_BASE}/zones/{self.zone_id}/dns_records/{record_id}"
         data = {
             "type": self.record_type,
             "name": self.full_domain,
@@ -97,28 +315,21 @@ class CloudflareDDNSUpdater:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.put(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-                    
-                    if result["success"]:
-                        logger.info(f"成功更新DNS记录: {self.full_domain} -> {ip}")
-                        return True
-                    else:
-                        logger.error(f"更新DNS记录失败: {result['errors']}")
-                        return False
-        except aiohttp.ClientError as e:
-            logger.error(f"更新DNS记录请求失败: {str(e)}")
+            result = await self.api.request("PUT", url, json=data)
+            if result.get("success"):
+                logger.info(f"成功更新DNS记录: {self.full_domain} -> {ip}")
+                return True
+            else:
+                logger.error(f"更新DNS记录失败: {result.get('errors')}")
+                return False
+        except CloudflareAPIError as e:
+            logger.error(f"更新DNS记录请求失败: {str(e)}, 错误详情: {e.errors}")
             return False
 
+    @traced('cf_create_record')
     async def _create_dns_record(self, ip: str) -> bool:
         """创建DNS记录（异步版本）"""
-        url = f"https://api.cloudflare.com/client/v4/zones/{self.zone_id}/dns_records"
-        headers = {
-            "Authorization": f"Bearer {self.cf_token}",
-            "Content-Type": "application/json"
-        }
+        url = f"{CLOUDFLARE_API_BASE}/zones/{self.zone_id}/dns_records"
         data = {
             "type": self.record_type,
             "name": self.full_domain,
@@ -128,23 +339,38 @@ class CloudflareDDNSUpdater:
         }
         
         try:
-            async with aiohttp.ClientSession() as session:
-                async with session.post(url, headers=headers, json=data, timeout=aiohttp.ClientTimeout(total=10)) as response:
-                    response.raise_for_status()
-                    result = await response.json()
-                    
-                    if result["success"]:
-                        logger.info(f"成功创建DNS记录: {self.full_domain} -> {ip}")
-                        return True
-                    else:
-                        logger.error(f"创建DNS记录失败: {result['errors']}")
-                        return False
-        except aiohttp.ClientError as e:
-            logger.error(f"创建DNS记录请求失败: {str(e)}")
+            result = await self.api.request("POST", url, json=data)
+            if result.get("success"):
+                logger.info(f"成功创建DNS记录: {self.full_domain} -> {ip}")
+                return True
+            else:
+                logger.error(f"创建DNS记录失败: {result.get('errors')}")
+                return False
+        except CloudflareAPIError as e:
+            logger.error(f"创建DNS记录请求失败: {str(e)}, 错误详情: {e.errors}")
             return False
 
     def _get_lowest_latency_ip(self) -> Optional[str]:
         """从结果文件中获取延迟最低的IP"""
+        with span('select_ip'):
+            return self._select_lowest_latency_ip()
+
+    def _selection_field(self, rows) -> str:
+        """确定选择IP所用的列：指定的列没有数据时回退到平均延迟"""
+        def has_values(field: str) -> bool:
+            return any((row.get(field) or '').strip() for row in rows)
+
+        metric = self.config.get("selection_metric") or "auto"
+        if metric == "auto":
+            # 执行过HTTPS延迟探测时按真实HTTPS延迟（连接+握手+首字节）选择，否则按扫描器的平均延迟
+            return 'HTTPS延迟(ms)' if has_values('HTTPS延迟(ms)') else '平均延迟'
+        if has_values(metric):
+            return metric
+        logger.warning(f"结果文件中没有 {metric} 数据，按平均延迟选择")
+        return '平均延迟'
+
+    def _select_lowest_latency_ip(self) -> Optional[str]:
+        """解析结果文件并选出延迟最低的IP"""
         try:
             # 获取绝对路径，确保基于脚本所在目录
             script_dir = os.path.dirname(os.path.abspath(__file__))
@@ -154,40 +380,29 @@ class CloudflareDDNSUpdater:
                 logger.error(f"结果文件不存在: {result_file_path}")
                 return None
             
-            with open(result_file_path, 'r', encoding='utf-8') as f:
-                # 跳过标题行
-                next(f, None)
-                
-                min_latency = float('inf')
-                best_ip = None
+            with open(result_file_path, 'r', encoding='utf-8-sig', newline='') as f:
+                rows = [row for row in csv.DictReader(f) if (row.get('IP 地址') or '').strip()]
+            
+            latency_field = self._selection_field(rows)
+            
+            min_latency = float('inf')
+            best_ip = None
+            for row in rows:
+                value = (row.get(latency_field) or '').strip()
+                if not value:
+                    continue
+                try:
+                    latency = float(value)
+                except ValueError:
+                    logger.warning(f"无效的延迟值: {value}，跳过此IP")
+                    continue
                 
-                for line in f:
-                    line = line.strip()
-                    if not line:
-                        continue
-                    
-                    try:
-                        # 根据实际CSV格式: IP 地址,已发送,已接收,丢包率,平均延迟,下载速度(MB/s),地区码
-                        parts = line.split(',')
-                        if len(parts) < 5:
-                            continue
-                        
-                        ip = parts[0].strip()
-                        try:
-                            latency = float(parts[4].strip())
-                        except ValueError:
-                            logger.warning(f"无效的延迟值: {parts[4].strip()}，跳过此IP")
-                            continue
-                        
-                        if latency < min_latency:
-                            min_latency = latency
-                            best_ip = ip
-                    except ValueError as e:
-                        logger.warning(f"解析行失败: {line}, 错误: {str(e)}")
-                        continue
+                if latency < min_latency:
+                    min_latency = latency
+                    best_ip = row['IP 地址'].strip()
             
             if best_ip:
-                logger.info(f"找到延迟最低的IP: {best_ip}, 延迟: {min_latency:.2f}ms")
+                logger.info(f"找到延迟最低的IP: {best_ip}, {latency_field}: {min_latency:.2f}ms")
                 return best_ip
             else:
                 logger.warning("未找到有效的IP地址")
@@ -196,41 +411,56 @@ class CloudflareDDNSUpdater:
             logger.error(f"读取结果文件失败: {str(e)}")
             return None
 
-    async def update_ddns(self) -> bool:
-        """更新DDNS记录（异步版本）"""
+    @traced('update_ddns')
+    async def update_ddns(self, ip: str = None) -> bool:
+        """
+        更新DDNS记录（异步版本）
+        :param ip: 指定发布的IP（如高峰预选），默认从结果文件中选择延迟最低的IP
+        """
         # 获取延迟最低的IP
-        new_ip = self._get_lowest_latency_ip()
+        new_ip = ip or self._get_lowest_latency_ip()
         if not new_ip:
             return False
         
-        # 获取记录ID
-        record_id = await self._get_record_id()
+        # 获取记录ID（限流、429及5xx重试由API调度器统一处理）
+        try:
+            record_id = await self._get_record_id()
+        except CloudflareAPIError:
+            return False
         
-        # 重试机制
-        for attempt in range(self.retry_count):
-            if record_id:
-                # 更新现有记录
-                if await self._update_dns_record(record_id, new_ip):
-                    return True
-            else:
-                # 创建新记录
-                if await self._create_dns_record(new_ip):
-                    return True
-            
-            # 重试前等待
-            if attempt < self.retry_count - 1:
-                logger.info(f"更新失败，{self.retry_interval}秒后重试...")
-                await asyncio.sleep(self.retry_interval)
+        if record_id:
+            # 更新现有记录
+            success = await self._update_dns_record(record_id, new_ip)
+        else:
+            # 创建新记录
+            success = await self._create_dns_record(new_ip)
+        
+        if success:
+            self.last_ip = new_ip
+            if self.verify_resolvers:
+                await self.verify_propagation(new_ip)
+        return success
+
+    async def verify_propagation(self, ip: str) -> Dict[str, Dict]:
+        """并发查询配置的解析器，等待记录在所有解析器上生效并记录收敛耗时"""
+        from .dns_verify import PropagationVerifier
         
-        logger.error(f"达到最大重试次数({self.retry_count})，更新失败")
-        return False
+        verifier = PropagationVerifier(
+            self.verify_resolvers,
+            deadline=self.config["verify_timeout"],
+            interval=self.config["verify_interval"]
+        )
+        logger.info(f"开始验证DNS传播: {self.full_domain} -> {ip}, 解析器: {', '.join(self.verify_resolvers)}")
+        self.last_verification = await verifier.verify(self.full_domain, self.record_type, ip)
+        return self.last_verification
 
-    def run(self):
-        """运行DDNS更新服务，成功后退出"""
+    def run(self) -> bool:
+        """运行DDNS更新服务，成功后退出（在独立进程中使用，不能在已运行的事件循环中调用）"""
         logger.info(f"启动Cloudflare DDNS更新，域名: {self.full_domain}")
         
-        success = self.update_ddns()
+        success = asyncio.run(self.update_ddns())
         if success:
             logger.info("DDNS更新成功，程序退出")
         else:
             logger.error("DDNS更新失败，程序退出")
+        return success
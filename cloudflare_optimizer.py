@@ -1,90 +1,285 @@
 import os
+import csv
 import time
+import asyncio
 import tempfile
-import aiohttp
 import zipfile
-import subprocess
 import platform
-from typing import List
+from typing import TYPE_CHECKING, Dict, List, Optional
 from astrbot.api import logger
 
+from .result_snapshots import ScanSnapshotStore
+from .tracing import Span, span, start_span, traced
+
+# 采样、地址段、分时段统计、归档等子系统只在启用或首次使用时导入
+if TYPE_CHECKING:
+    from .hourly_model import HourlyLatencyModel
+    from .prefix_sampler import PrefixBanditSampler
+    from .range_feeds import IntervalIndex
+    from .scan_archive import ScanArchive
+
+# HTTPS延迟探测写入结果文件的列 -> 探测结果字段
+HTTPS_PROBE_FIELDS = {
+    'TCP连接(ms)': 'connect_ms',
+    'TLS握手(ms)': 'tls_ms',
+    'HTTPS首字节(ms)': 'ttfb_ms',
+    'HTTPS延迟(ms)': 'total_ms'
+}
+
+# 多样本延迟采集写入结果文件的列 -> 草图统计字段
+PERCENTILE_FIELDS = {
+    'P50延迟(ms)': 'p50',
+    'P95延迟(ms)': 'p95',
+    'P99延迟(ms)': 'p99',
+    '抖动(ms)': 'jitter'
+}
+
 class CloudflareIPOptimizer:
     """Cloudflare IP优选器核心类"""
     
-    def __init__(self, cloudflarespeedtest_path: str = None):
+    def __init__(self, cloudflarespeedtest_path: str = None, config: Dict = None):
         """
         初始化Cloudflare IP优选器
+        工具目录与可执行文件路径在首次使用时才解析并缓存，构造本身不访问文件系统
         :param cloudflarespeedtest_path: CloudflareSpeedTest可执行文件路径
+        :param config: 插件配置
         """
-        logger.info("=== 初始化Cloudflare IP优选器 ===")
-        
-        if cloudflarespeedtest_path is None:
-            # 自动检测cfst目录下的可执行文件
-            cfst_dir = self._get_cfst_dir()
-            logger.info(f"CloudflareSpeedTest目录: {cfst_dir}")
-            
-            # 检测当前操作系统
-            system = platform.system().lower()
-            logger.info(f"检测到的操作系统: {system}")
-            
-            # 根据操作系统设置默认路径
-            default_paths = []
-            if 'windows' in system:
-                default_paths = [
-                    os.path.join(cfst_dir, 'cfst.exe'),
-                    os.path.join(cfst_dir, 'CloudflareSpeedTest.exe'),
-                ]
-            else:
-                default_paths = [
-                    os.path.join(cfst_dir, 'cfst'),
-                    os.path.join(cfst_dir, 'CloudflareSpeedTest'),
-                ]
-            
-            logger.info(f"检测路径列表: {default_paths}")
-            
-            for path in default_paths:
-                if os.path.exists(path):
-                    cloudflarespeedtest_path = path
-                    logger.info(f"✅ 找到工具: {path}")
-                    break
-                else:
-                    logger.debug(f"❌ 路径不存在: {path}")
-            else:
-                # 如果没有找到，设置为默认值
-                if 'windows' in system:
-                    cloudflarespeedtest_path = os.path.join(cfst_dir, 'CloudflareSpeedTest.exe')
-                else:
-                    cloudflarespeedtest_path = os.path.join(cfst_dir, 'CloudflareSpeedTest')
-                logger.info(f"❌ 未找到工具，使用默认路径: {cloudflarespeedtest_path}")
+        self.config = config or {}
+        self._explicit_path = cloudflarespeedtest_path
+        self._resolved_path = None
+        self._cfst_dir = None
+        self._snapshots = None
+        self._range_index = None
+        self._range_index_key = None
+        # 最近一次成功运行的结果文件（快照目录中），未发布的复测结果也从这里读取
+        self.last_result_path: Optional[str] = None
+
+    @property
+    def cloudflarespeedtest_path(self) -> str:
+        """CloudflareSpeedTest可执行文件路径（首次访问时解析并缓存）"""
+        if self._resolved_path is None:
+            self._resolved_path = self._resolve_tool_path()
+        return self._resolved_path
+
+    @cloudflarespeedtest_path.setter
+    def cloudflarespeedtest_path(self, path: str):
+        self._resolved_path = path
+
+    def invalidate_paths(self):
+        """清除缓存的目录与工具路径，下次访问时重新解析（如下载工具后）"""
+        self._resolved_path = None
+        self._cfst_dir = None
+
+    def _resolve_tool_path(self) -> str:
+        """解析CloudflareSpeedTest可执行文件路径"""
+        if self._explicit_path is not None:
+            logger.info(f"使用指定路径: {self._explicit_path}")
+            return self._explicit_path
+
+        # 自动检测cfst目录下的可执行文件
+        cfst_dir = self._get_cfst_dir()
+        system = platform.system().lower()
+        logger.debug(f"CloudflareSpeedTest目录: {cfst_dir}, 操作系统: {system}")
+
+        # 根据操作系统设置默认路径
+        if 'windows' in system:
+            default_paths = [
+                os.path.join(cfst_dir, 'cfst.exe'),
+                os.path.join(cfst_dir, 'CloudflareSpeedTest.exe'),
+            ]
         else:
-            logger.info(f"使用指定路径: {cloudflarespeedtest_path}")
-            
-        self.cloudflarespeedtest_path = cloudflarespeedtest_path
-        logger.info(f"最终工具路径: {self.cloudflarespeedtest_path}")
-        logger.info("=== 初始化完成 ===")
+            default_paths = [
+                os.path.join(cfst_dir, 'cfst'),
+                os.path.join(cfst_dir, 'CloudflareSpeedTest'),
+            ]
+
+        for path in default_paths:
+            if os.path.exists(path):
+                logger.info(f"✅ 找到工具: {path}")
+                return path
+            logger.debug(f"❌ 路径不存在: {path}")
+
+        # 如果没有找到，使用默认值
+        path = default_paths[-1]
+        logger.info(f"❌ 未找到工具，使用默认路径: {path}")
+        return path
         
     def _get_cfst_dir(self) -> str:
-        """获取cfst目录路径"""
-        current_dir = os.path.dirname(os.path.abspath(__file__))
-        target_dir = os.path.join(current_dir, 'csft')
-        os.makedirs(target_dir, exist_ok=True)
-        return target_dir
+        """获取cfst目录路径（首次调用时创建目录并缓存）"""
+        if self._cfst_dir is None:
+            current_dir = os.path.dirname(os.path.abspath(__file__))
+            target_dir = os.path.join(current_dir, 'csft')
+            os.makedirs(target_dir, exist_ok=True)
+            self._cfst_dir = target_dir
+        return self._cfst_dir
+
+    @property
+    def snapshots(self) -> ScanSnapshotStore:
+        """扫描结果快照存储"""
+        if self._snapshots is None:
+            self._snapshots = ScanSnapshotStore(self._get_cfst_dir(), self.config.get('snapshot_retention', 10))
+        return self._snapshots
+
+    def get_prefix_sampler(self, ranges: List[str] = None) -> "PrefixBanditSampler":
+        """
+        创建前缀自适应采样器（地址段可能在下载工具后变化，因此每次重新读取）
+        :param ranges: 候选地址段，默认读取cfst自带的地址段文件
+        """
+        from .prefix_sampler import PrefixBanditSampler
+        
+        cfst_dir = self._get_cfst_dir()
+        ipv6 = self.config.get('record_type', 'A') == 'AAAA'
+        return PrefixBanditSampler(
+            os.path.join(cfst_dir, 'prefix_stats.json'),
+            ranges or PrefixBanditSampler.load_ranges(cfst_dir, ipv6=ipv6),
+            exploration_ratio=self.config.get('exploration_ratio', 0.2)
+        )
+
+    def get_hourly_model(self) -> "HourlyLatencyModel":
+        """创建分时段延迟模型（状态保存在cfst目录）"""
+        from .hourly_model import HourlyLatencyModel
+        
+        return HourlyLatencyModel(os.path.join(self._get_cfst_dir(), 'hourly_stats.json'))
+
+    def get_scan_archive(self) -> "ScanArchive":
+        """打开扫描结果的列式归档（保存在cfst目录下的archive目录）"""
+        from .scan_archive import ScanArchive
+        
+        return ScanArchive(os.path.join(self._get_cfst_dir(), 'archive'))
+
+    def _range_feed_urls(self) -> List[str]:
+        from .range_feeds import DEFAULT_FEED_URLS
+        
+        urls = self.config.get('range_feed_urls', '')
+        if isinstance(urls, str):
+            urls = [url.strip() for url in urls.split(',') if url.strip()]
+        return urls or DEFAULT_FEED_URLS
+
+    async def get_range_index(self, force_refresh: bool = False) -> Optional["IntervalIndex"]:
+        """
+        获取候选地址段索引（订阅源 + 本地允许列表 - 本地拒绝列表）
+        未启用订阅源且未配置允许/拒绝列表时返回None
+        :param force_refresh: 忽略刷新间隔，立即发起条件请求
+        """
+        enabled = self.config.get('enable_range_feeds', False)
+        allowlist = self.config.get('range_allowlist', '')
+        denylist = self.config.get('range_denylist', '')
+        if not (enabled or allowlist or denylist):
+            return None
+        from .prefix_sampler import PrefixBanditSampler
+        from .range_feeds import RangeFeedCache, build_range_index, list_signature, load_list, parse_ranges
+
+        cfst_dir = self._get_cfst_dir()
+        changed = False
+        if enabled:
+            cache = RangeFeedCache(
+                os.path.join(cfst_dir, 'feeds'),
+                self._range_feed_urls(),
+                refresh_interval=self.config.get('range_refresh_interval', 86400)
+            )
+            changed = await cache.refresh(force=force_refresh)
+        # 允许/拒绝列表文件被编辑后（修改时间变化）重新构建索引
+        key = (list_signature(allowlist, cfst_dir), list_signature(denylist, cfst_dir))
+        if self._range_index is None or changed or key != self._range_index_key:
+            with span('build_range_index'):
+                feed_networks = cache.load() if enabled else []
+                if not feed_networks:
+                    # 订阅源不可用（或未启用）时以cfst自带的地址段为基础
+                    feed_networks = parse_ranges('\n'.join(
+                        PrefixBanditSampler.load_ranges(cfst_dir, ipv6=False)
+                        + PrefixBanditSampler.load_ranges(cfst_dir, ipv6=True)
+                    ))
+                self._range_index = build_range_index(
+                    feed_networks, load_list(allowlist, cfst_dir), load_list(denylist, cfst_dir)
+                )
+                self._range_index_key = key
+            logger.info(f"地址段索引已构建: {len(self._range_index)}个区间, "
+                        f"IPv4地址{self._range_index.num_addresses(4)}个")
+        return self._range_index
+
+    def filter_results(self, result_file: str, index: "IntervalIndex") -> int:
+        """
+        剔除不在地址段索引中的扫描结果（如已拉黑或不属于Cloudflare的IP）
+        :return: 被剔除的行数
+        """
+        rows = self.read_results(result_file)
+        kept = [row for row in rows if row['IP 地址'].strip() in index]
+        removed = len(rows) - len(kept)
+        if removed:
+            self.write_results(result_file, kept)
+            logger.info(f"已剔除{removed}个不在候选地址段内的IP")
+        return removed
+
+    @staticmethod
+    def _pop_arg(args: List[str], flag: str) -> str:
+        """从参数列表中移除指定参数及其值，返回该值（不存在时返回None）"""
+        if flag not in args:
+            return None
+        index = args.index(flag)
+        value = args[index + 1] if index + 1 < len(args) else None
+        del args[index:index + 2]
+        return value
+
+    def read_results(self, result_file: str = None) -> List[Dict[str, str]]:
+        """
+        读取测速结果CSV文件
+        :param result_file: 结果文件路径，默认为cfst目录下的result.csv
+        :return: 以表头为键的行列表，文件不存在时返回空列表
+        """
+        if result_file is None:
+            result_file = self.snapshots.result_path
+        if not os.path.exists(result_file):
+            return []
+        with span('parse_results', file=os.path.basename(result_file)):
+            with open(result_file, 'r', encoding='utf-8-sig', newline='') as f:
+                return [row for row in csv.DictReader(f) if row.get('IP 地址')]
+
+    @staticmethod
+    def write_results(result_file: str, rows: List[Dict[str, str]], extra_fields: List[str] = None):
+        """
+        写回测速结果CSV文件，保持原有列顺序并在末尾追加新列
+        :param extra_fields: 需要追加的列名
+        """
+        with open(result_file, 'r', encoding='utf-8-sig', newline='') as f:
+            fieldnames = next(csv.reader(f), [])
+        for field in extra_fields or []:
+            if field not in fieldnames:
+                fieldnames.append(field)
+        tmp_path = f"{result_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fieldnames, extrasaction='ignore')
+            writer.writeheader()
+            writer.writerows(rows)
+        os.replace(tmp_path, result_file)
+
+    @staticmethod
+    def sort_by_latency(rows: List[Dict[str, str]]) -> List[Dict[str, str]]:
+        """按平均延迟升序排序，无法解析延迟的行排在最后"""
+        def latency(row: Dict[str, str]) -> float:
+            try:
+                return float(row.get('平均延迟', ''))
+            except ValueError:
+                return float('inf')
+        return sorted(rows, key=latency)
         
+    @traced('download_tool')
     async def download_cloudflarespeedtest(self) -> bool:
         """自动下载并安装CloudflareSpeedTest工具（异步版本）"""
         logger.info("=== 开始下载CloudflareSpeedTest工具 ===")
+        import aiohttp
         
         try:
             # GitHub releases API URL
             api_url = "https://api.github.com/repos/XIU2/CloudflareSpeedTest/releases/latest"
             logger.info(f"请求GitHub API: {api_url}")
             
-            async with aiohttp.ClientSession() as session:
-                async with session.get(api_url) as response:
-                    logger.info(f"API响应状态码: {response.status}")
-                    response.raise_for_status()
-                    release_info = await response.json()
-                    logger.info(f"获取版本信息: {release_info.get('tag_name', '未知')}")
+            with span('github_api'):
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(api_url) as response:
+                        logger.info(f"API响应状态码: {response.status}")
+                        response.raise_for_status()
+                        release_info = await response.json()
+                        logger.info(f"获取版本信息: {release_info.get('tag_name', '未知')}")
 
             system = platform.system().lower()
             machine = platform.machine().lower()
@@ -180,12 +375,15 @@ class CloudflareIPOptimizer:
             
             # 异步下载文件
             logger.info("开始下载文件...")
-            async with aiohttp.ClientSession() as session:
-                async with session.get(download_url) as response:
-                    logger.info(f"下载响应状态码: {response.status}")
-                    response.raise_for_status()
-                    content = await response.read()
-                    logger.info(f"下载完成，文件大小: {len(content)} 字节")
+            with span('download_asset', url=download_url) as current:
+                async with aiohttp.ClientSession() as session:
+                    async with session.get(download_url) as response:
+                        logger.info(f"下载响应状态码: {response.status}")
+                        response.raise_for_status()
+                        content = await response.read()
+                        logger.info(f"下载完成，文件大小: {len(content)} 字节")
+                if current:
+                    current.set(bytes=len(content))
             
             # 保存到临时文件
             with tempfile.NamedTemporaryFile(suffix=file_suffix, delete=False) as tmp_file:
@@ -196,6 +394,7 @@ class CloudflareIPOptimizer:
             logger.info(f"解压目标目录: {cfst_dir}")
             
             # 根据文件类型选择解压方式
+            extract_span = start_span('extract')
             if file_suffix == '.zip':
                 logger.info("使用zipfile解压...")
                 with zipfile.ZipFile(tmp_file.name, 'r') as zip_ref:
@@ -208,11 +407,14 @@ class CloudflareIPOptimizer:
                     tar_ref.extractall(cfst_dir)
                     logger.info(f"解压完成，文件列表: {tar_ref.getnames()}")
             
+            if extract_span:
+                extract_span.finish()
             os.unlink(tmp_file.name)
             logger.info("临时文件已清理")
             logger.info("CloudflareSpeedTest下载并安装成功")
             
             # 更新工具路径
+            self.invalidate_paths()
             cfst_dir = self._get_cfst_dir()
             # 查找解压后的可执行文件
             for root, dirs, files in os.walk(cfst_dir):
@@ -234,10 +436,102 @@ class CloudflareIPOptimizer:
             logger.error(f"下载失败: {e}")
             return False
             
-    async def run_test(self, args: List[str] = None) -> bool:
+    async def _post_process(self, result_file: str):
+        """扫描结束后、快照发布前对结果执行的附加测试阶段"""
+        if self.config.get('enable_latency_sampling', False):
+            try:
+                with span('latency_sampling'):
+                    await self._run_latency_sampling_stage(result_file)
+            except Exception as e:
+                logger.warning(f"多样本延迟采集阶段失败，保留扫描器原始结果: {e}")
+        if self.config.get('enable_tls_probe', False):
+            try:
+                with span('tls_probe'):
+                    await self._run_tls_probe_stage(result_file)
+            except Exception as e:
+                logger.warning(f"HTTPS延迟探测阶段失败，保留扫描器原始结果: {e}")
+        if self.config.get('speed_test_url'):
+            try:
+                with span('throughput'):
+                    await self._run_throughput_stage(result_file)
+            except Exception as e:
+                logger.warning(f"下载测速阶段失败，保留扫描器原始结果: {e}")
+
+    async def _run_throughput_stage(self, result_file: str):
+        """通过自定义URL对延迟最低的若干IP进行下载测速，并写回结果文件"""
+        from .edge_probes import ThroughputTester
+
+        rows = self.read_results(result_file)
+        if not rows:
+            return
+        tester = ThroughputTester(
+            self.config['speed_test_url'],
+            concurrency=self.config.get('speed_test_concurrency', 4),
+            max_seconds=self.config.get('speed_test_max_seconds', 10),
+            max_bytes=int(self.config.get('speed_test_max_mb', 50) * 1024 * 1024)
+        )
+        top_rows = self.sort_by_latency(rows)[:self.config.get('speed_test_top_n', 10)]
+        results = await tester.measure_many([row['IP 地址'].strip() for row in top_rows])
+        for row, result in zip(top_rows, results):
+            row['下载速度(MB/s)'] = f"{result['speed']:.2f}"
+            row['首字节时间(ms)'] = f"{result['ttfb_ms']:.2f}" if result['ttfb_ms'] is not None else ''
+            if result['error']:
+                logger.debug(f"下载测速失败: {result['ip']} - {result['error']}")
+        self.write_results(result_file, rows, extra_fields=['首字节时间(ms)'])
+
+    async def _run_latency_sampling_stage(self, result_file: str):
+        """对延迟最低的若干IP多次采集连接延迟，写回p50/p95/p99与抖动"""
+        from .edge_probes import TCPPinger
+
+        rows = self.read_results(result_file)
+        if not rows:
+            return
+        pinger = TCPPinger(samples=self.config.get('latency_samples', 10))
+        top_rows = self.sort_by_latency(rows)[:self.config.get('latency_sample_top_n', 20)]
+        results = await pinger.measure_many([row['IP 地址'].strip() for row in top_rows])
+        for row, result in zip(top_rows, results):
+            summary = result['sketch'].summary()
+            for field, key in PERCENTILE_FIELDS.items():
+                row[field] = f"{summary[key]:.2f}" if summary[key] is not None else ''
+        self.write_results(result_file, rows, extra_fields=list(PERCENTILE_FIELDS))
+
+    async def _run_tls_probe_stage(self, result_file: str):
+        """以自己的域名作为SNI与Host，对延迟最低的若干IP探测HTTPS各阶段耗时，并写回结果文件"""
+        from .edge_probes import TLSProber
+
+        hostname = self.config.get('tls_probe_host') or self.config.get('main_domain')
+        if not hostname:
+            logger.warning("未配置tls_probe_host或main_domain，跳过HTTPS延迟探测")
+            return
+        rows = self.read_results(result_file)
+        if not rows:
+            return
+        prober = TLSProber(
+            hostname,
+            path=self.config.get('tls_probe_path', '/'),
+            samples=self.config.get('tls_probe_samples', 3),
+            concurrency=self.config.get('tls_probe_concurrency', 8),
+            timeout=self.config.get('tls_probe_timeout', 5)
+        )
+        top_rows = self.sort_by_latency(rows)[:self.config.get('tls_probe_top_n', 10)]
+        results = await prober.measure_many([row['IP 地址'].strip() for row in top_rows])
+        for row, result in zip(top_rows, results):
+            for field, key in HTTPS_PROBE_FIELDS.items():
+                row[field] = f"{result[key]:.2f}" if result[key] is not None else ''
+            if result['error']:
+                logger.debug(f"HTTPS延迟探测失败: {result['ip']} - {result['error']}")
+        self.write_results(result_file, rows, extra_fields=list(HTTPS_PROBE_FIELDS))
+
+    @traced('run_test')
+    async def run_test(self, args: List[str] = None, candidates: List[str] = None, record_history: bool = True,
+                       publish: bool = True) -> bool:
         """
         运行CloudflareSpeedTest进行IP测试
         :param args: 额外的命令行参数
+        :param candidates: 只测试指定的IP（如高峰前复测历史优选IP），此时不使用自适应采样和地址段订阅
+        :param record_history: 是否把结果计入分时段统计、扫描归档和自适应采样统计（定向复测时应关闭，避免偏向已有的优选IP）
+        :param publish: 是否把结果发布为当前结果（result.csv）；为False时快照标记为复测（rescan），
+                        结果通过last_result_path读取
         :return: 是否运行成功
         """
         logger.info("=== 开始执行Cloudflare IP优选测试 ===")
@@ -252,6 +546,10 @@ class CloudflareIPOptimizer:
             
         logger.info(f"测试参数: {args}")
         
+        run = None
+        process = None
+        monitor = None
+        scan_span = phase_span = None
         try:
             # 检查工具是否存在
             logger.info(f"检查工具路径: {self.cloudflarespeedtest_path}")
@@ -265,47 +563,76 @@ class CloudflareIPOptimizer:
             else:
                 logger.info(f"✅ 工具已存在: {self.cloudflarespeedtest_path}")
             
-            # 添加输出CSV格式参数
-            if '-o' not in args:
-                # 与ddns.py配置保持一致
-                result_file = os.path.join(self._get_cfst_dir(), 'result.csv')
-                args.extend(['-o', result_file])
-            else:
-                # 如果已存在-o参数，确保使用完整路径
-                o_index = args.index('-o')
-                if o_index + 1 < len(args):
-                    result_file = os.path.join(self._get_cfst_dir(), args[o_index + 1])
-                    args[o_index + 1] = result_file
+            # 结果写入独立的运行目录，校验通过后再原子发布为result.csv
+            args = list(args)
+            self._pop_arg(args, '-o')
+            try:
+                range_index = await self.get_range_index()
+            except Exception as e:
+                logger.warning(f"构建地址段索引失败，本次不过滤结果: {e}")
+                range_index = None
+            version = 6 if self.config.get('record_type', 'A') == 'AAAA' else 4
+            sampler = None
+            if candidates is not None:
+                self._pop_arg(args, '-f')
+            elif self.config.get('enable_adaptive_sampling', False):
+                # 自适应采样时由采样器生成候选IP文件，替代用户指定的-f
+                self._pop_arg(args, '-f')
+                sampler = self.get_prefix_sampler(range_index.networks(version) if range_index is not None else None)
+            if self.config.get('speed_test_url') and '-dd' not in args:
+                # 使用自定义URL测速时跳过扫描器自带的下载测速
+                args.append('-dd')
+            run = self.snapshots.begin_run(args)
+            args.extend(['-o', run.result_path])
+            if candidates is not None:
+                candidates_file = os.path.join(run.run_dir, 'candidates.txt')
+                with open(candidates_file, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(candidates) + '\n')
+                args.extend(['-f', candidates_file])
+            elif sampler is not None:
+                candidates_file = os.path.join(run.run_dir, 'candidates.txt')
+                probed_ips = sampler.write_candidates(candidates_file, self.config.get('sampling_budget', 2000))
+                args.extend(['-f', candidates_file])
+            elif range_index is not None and self.config.get('enable_range_feeds', False) and '-f' not in args:
+                # 订阅源生效时以合并后的地址段作为扫描范围
+                ranges_file = os.path.join(run.run_dir, 'ranges.txt')
+                with open(ranges_file, 'w', encoding='utf-8') as f:
+                    f.write('\n'.join(range_index.networks(version)) + '\n')
+                args.extend(['-f', ranges_file])
             
             # 构建命令时确保使用完整的绝对路径
             cmd = [self.cloudflarespeedtest_path] + args
             logger.info(f"完整命令: {' '.join(cmd)}")
             logger.info(f"工作目录: {self._get_cfst_dir()}")
 
-            # 执行命令，捕获输出但不实时打印
+            # 执行命令，捕获输出但不实时打印（异步子进程，任务被取消时可以终止扫描器）
             logger.info("开始执行命令...")
-            process = subprocess.Popen(
-                cmd,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.STDOUT,
-                shell=False,
-                cwd=self._get_cfst_dir(),
-                text=True,
-                encoding='utf-8',
-                errors='replace'
+            process = await asyncio.create_subprocess_exec(
+                *cmd,
+                stdout=asyncio.subprocess.PIPE,
+                stderr=asyncio.subprocess.STDOUT,
+                cwd=self._get_cfst_dir()
             )
             logger.info(f"进程PID: {process.pid}")
+            scan_span = start_span('scan', pid=process.pid)
 
-            output = []
+            from .scan_output import ScanOutputMonitor, prune_spool_dir
+
+            # 输出只流式处理一次：保留最近若干行用于诊断，日志限流，可选完整输出写入gzip日志
+            spool_path = None
+            if self.config.get('scan_log_spool', False):
+                spool_dir = os.path.join(self._get_cfst_dir(), 'scan_logs')
+                spool_path = os.path.join(spool_dir, f"{run.run_id}.log.gz")
+                prune_spool_dir(spool_dir, max(0, self.config.get('scan_log_retention', 10) - 1))
+            monitor = ScanOutputMonitor(
+                tail_lines=self.config.get('scan_output_tail_lines', 50),
+                log_interval=self.config.get('scan_output_log_interval', 5),
+                spool_path=spool_path
+            )
             timeout = 300 # 添加超时参数
             start_time = time.time()
             last_output_time = start_time
 
-            # 定义成功指标
-            success_indicators = ["延迟测速完成", "完整测速结果已写入", "测试完成", "完成测试", "测试结束"]
-            # 添加一个标志来指示是否找到了成功指标
-            success_found = False
-
             logger.info(f"开始监控进程，超时时间: {timeout}秒")
             
             while True:
@@ -314,56 +641,76 @@ class CloudflareIPOptimizer:
                 elapsed_time = current_time - start_time
                 
                 if current_time - start_time > timeout:
-                    process.kill()
                     logger.error(f"❌ 命令执行超时 ({timeout}秒)，已运行: {elapsed_time:.1f}秒")
                     return False
 
-                # 非阻塞读取输出
-                line = process.stdout.readline()
-                if line:
-                    last_output_time = current_time
-                    output.append(line)
-                    logger.debug(f"进程输出: {line.strip()}")
+                # 按块读取输出，最多等待1秒以便检查超时；进度条以\r刷新，行由监控器按\r与\n切分
+                try:
+                    chunk = await asyncio.wait_for(process.stdout.read(65536), 1)
+                except asyncio.TimeoutError:
+                    chunk = None
+                if chunk:
+                    # 只要有输出（包括进度条刷新）就不算卡住
+                    last_output_time = time.time()
+                    lines = monitor.feed_chunk(chunk)
+                elif chunk is not None:
+                    lines = monitor.flush()
+                else:
+                    lines = []
+
+                success_seen = False
+                for line in lines:
+                    # 根据扫描器输出划分延迟测速与下载测速阶段
+                    if scan_span is not None:
+                        for marker, phase in (('开始延迟测速', 'latency'), ('开始下载测速', 'download')):
+                            if marker in line:
+                                if phase_span is not None:
+                                    phase_span.finish()
+                                phase_span = Span(phase, scan_span)
 
                     # 检查是否包含成功指标
-                    if not success_found and any(indicator in line for indicator in success_indicators):
-                        success_found = True
-                        logger.info(f"✅ 检测到测试进度: {line.strip()}")
-                        # 继续等待进程结束，最多再等待10秒
-                        wait_time = 0
-                        while process.poll() is None and wait_time < 10:
-                            time.sleep(0.5)
-                            wait_time += 0.5
+                    if monitor.success_line == line:
+                        logger.info(f"✅ 检测到测试进度: {line}")
+                        success_seen = True
                         break
 
-                elif process.poll() is not None:
-                    # 进程已结束
+                if success_seen:
+                    # 继续等待进程结束，最多再等待10秒
+                    try:
+                        await asyncio.wait_for(process.wait(), 10)
+                    except asyncio.TimeoutError:
+                        pass
+                    break
+                elif chunk is not None and not chunk:
+                    # 输出已结束，进程退出
+                    await process.wait()
                     logger.info(f"进程正常结束，返回码: {process.returncode}")
                     break
                 elif current_time - last_output_time > 120:
                     # 2分钟没有输出，认为进程卡住
-                    process.kill()
                     logger.error(f"❌ 命令执行无响应 (超过2分钟没有输出)，已运行: {elapsed_time:.1f}秒")
                     return False
 
-                # 短暂休眠避免CPU占用过高
-                time.sleep(0.1)
-
-            output_str = ''.join(output)
+            for finished_span in (phase_span, scan_span):
+                if finished_span is not None:
+                    finished_span.finish()
+            monitor.close()
+            success_found = monitor.success_found
             return_code = process.returncode
             elapsed_time = time.time() - start_time
             logger.info(f"命令执行完成，返回码: {return_code}, 运行时间: {elapsed_time:.1f}秒")
-            logger.info(f"输出总行数: {len(output)} 行")
+            logger.info(f"输出总行数: {monitor.line_count} 行 ({monitor.byte_count}字节)")
+            if monitor.spool_path:
+                logger.info(f"完整输出已写入: {monitor.spool_path}")
             
             # 记录关键输出信息
-            if output_str:
-                logger.debug(f"完整输出:\n{output_str}")
+            if monitor.line_count:
+                logger.debug("最后输出内容:\n" + '\n'.join(monitor.tail))
             else:
                 logger.warning("❌ 没有获取到任何输出")
 
             # 确定输出文件路径
-            output_file = args[-1] if len(args) > 0 and args[-2] == '-o' else 'result.csv'
-            output_file_path = os.path.join(self._get_cfst_dir(), output_file)
+            output_file_path = run.result_path
             logger.info(f"预期结果文件: {output_file_path}")
 
             # 检查文件状态
@@ -376,7 +723,7 @@ class CloudflareIPOptimizer:
                 logger.warning(f"❌ 结果文件不存在: {output_file_path}")
 
             # 检查命令是否成功执行
-            success_condition = (return_code == 0 and (success_found or any(indicator in output_str for indicator in success_indicators))) or \
+            success_condition = (return_code == 0 and success_found) or \
                (success_found and file_exists and file_size > 0)
             
             logger.info(f"成功条件检查结果: {success_condition}")
@@ -386,15 +733,44 @@ class CloudflareIPOptimizer:
                 logger.info("✅ Cloudflare IP优选测试成功完成")
                 logger.info(f"📊 完整测速结果已写入: {output_file_path}")
                 
-                # 读取结果文件前几行作为验证
-                if file_exists and file_size > 0:
+                # 进程可能在检测到完成标志后仍在写文件，等待其退出后再校验发布
+                if process.returncode is None:
+                    logger.warning("进程尚未退出，终止进程后校验结果文件")
+                    process.kill()
+                    await process.wait()
+                
+                if range_index is not None:
+                    with span('filter_ranges'):
+                        self.filter_results(run.result_path, range_index)
+                await self._post_process(run.result_path)
+                
+                try:
+                    with span('commit_snapshot'):
+                        self.snapshots.commit(run, extra=None if publish else {'rescan': True}, publish=publish)
+                    self.last_result_path = run.result_path
+                except ValueError as e:
+                    logger.error(f"❌ 结果文件校验失败，未发布本次结果: {e}")
+                    return False
+                
+                if record_history and self.config.get('enable_scan_archive', False):
                     try:
-                        with open(output_file_path, 'r', encoding='utf-8') as f:
-                            first_line = f.readline().strip()
-                            logger.info(f"结果文件首行: {first_line}")
+                        with span('archive_results'):
+                            self.get_scan_archive().append_run(run.run_id, self.read_results(run.result_path))
                     except Exception as e:
-                        logger.warning(f"读取结果文件失败: {e}")
-                        
+                        logger.warning(f"归档扫描结果失败: {e}")
+                if record_history and self.config.get('enable_peak_prediction', False):
+                    try:
+                        with span('update_hourly_model'):
+                            self.get_hourly_model().record(self.read_results(run.result_path))
+                    except Exception as e:
+                        logger.warning(f"更新分时段延迟统计失败: {e}")
+                if record_history and sampler is not None:
+                    try:
+                        latency_cap = float(args[args.index('-tl') + 1]) if '-tl' in args else 1000.0
+                        with span('update_sampler'):
+                            sampler.update(probed_ips, self.read_results(run.result_path), latency_cap)
+                    except Exception as e:
+                        logger.warning(f"更新自适应采样统计失败: {e}")
                 return True
 
             # 失败情况详细记录
@@ -405,16 +781,10 @@ class CloudflareIPOptimizer:
             logger.error(f"  - 结果文件: {file_exists} (是否存在)")
             logger.error(f"  - 文件大小: {file_size}字节")
             
-            if output_str:
-                # 提取错误信息
-                error_lines = [line for line in output_str.split('\n') if any(keyword in line.lower() for keyword in ['error', '错误', 'failed', '失败', 'exception'])]
-                if error_lines:
-                    logger.error(f"错误信息摘要:\n" + '\n'.join(error_lines[-5:]))  # 最后5条错误
-                else:
-                    # 记录最后几行输出
-                    lines = output_str.split('\n')
-                    last_lines = lines[-10:] if len(lines) > 10 else lines
-                    logger.error(f"最后输出内容:\n" + '\n'.join(last_lines))
+            if monitor.line_count:
+                # 错误信息摘要（最近的错误行），没有错误行时记录最后几行输出
+                title = "错误信息摘要" if monitor.errors else "最后输出内容"
+                logger.error(f"{title}:\n" + '\n'.join(monitor.summary()))
             
             return False
         except FileNotFoundError:
@@ -426,3 +796,16 @@ class CloudflareIPOptimizer:
         except Exception as e:
             logger.error(f"发生错误: {str(e)}")
             return False
+        finally:
+            # 超时、异常或任务被取消时终止仍在运行的扫描器
+            if process is not None and process.returncode is None:
+                logger.warning(f"终止扫描器进程: {process.pid}")
+                process.kill()
+                await process.wait()
+            for finished_span in (phase_span, scan_span):
+                if finished_span is not None:
+                    finished_span.finish()
+            if monitor is not None:
+                monitor.close()
+            if run is not None and not run.committed:
+                self.snapshots.discard(run)
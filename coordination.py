@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import shutil
+import socket
+import sqlite3
+import asyncio
+from abc import ABC, abstractmethod
+from contextlib import closing
+from typing import Dict, Optional
+from astrbot.api import logger
+
+from .result_snapshots import ScanSnapshotStore
+
+SHARED_SNAPSHOT_DIR = 'snapshot'
+# 共享目录中指向当前快照的指针文件；每次发布写入独立的运行目录，再原子替换指针
+SHARED_POINTER_FILE = 'CURRENT'
+# 共享目录保留的已发布快照数（从节点可能仍在读取上一个）
+SHARED_SNAPSHOT_RETENTION = 3
+
+
+class LeaseBackend(ABC):
+    """租约后端接口：同一时间只有一个节点持有租约"""
+
+    @abstractmethod
+    def try_acquire(self, node_id: str, ttl: float) -> Optional[float]:
+        """
+        尝试获取或续期租约
+        :return: 成功时返回租约到期时间戳，租约被其他节点持有时返回None
+        """
+
+    @abstractmethod
+    def release(self, node_id: str):
+        """释放本节点持有的租约"""
+
+    @abstractmethod
+    def holder(self) -> Optional[Dict]:
+        """当前租约持有者（node_id、expires_at），无人持有时返回None"""
+
+
+class SQLiteLeaseBackend(LeaseBackend):
+    """基于SQLite租约表的后端，数据库文件放在各节点共享的存储上"""
+
+    def __init__(self, db_path: str, lease_name: str = 'cloudflare_ip_optimizer'):
+        self.db_path = db_path
+        self.lease_name = lease_name
+        os.makedirs(os.path.dirname(db_path) or '.', exist_ok=True)
+        with closing(self._connect()) as conn:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS leases ("
+                "name TEXT PRIMARY KEY, holder TEXT NOT NULL, expires_at REAL NOT NULL, acquired_at REAL NOT NULL)"
+            )
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.db_path, timeout=10, isolation_level=None)
+
+    def try_acquire(self, node_id: str, ttl: float) -> Optional[float]:
+        now = time.time()
+        conn = self._connect()
+        try:
+            # BEGIN IMMEDIATE 获取写锁，保证“检查-写入”原子执行
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT holder, expires_at, acquired_at FROM leases WHERE name = ?",
+                               (self.lease_name,)).fetchone()
+            if row is not None and row[0] != node_id and row[1] > now:
+                conn.execute("ROLLBACK")
+                return None
+            acquired_at = row[2] if row is not None and row[0] == node_id else now
+            conn.execute(
+                "INSERT OR REPLACE INTO leases (name, holder, expires_at, acquired_at) VALUES (?, ?, ?, ?)",
+                (self.lease_name, node_id, now + ttl, acquired_at)
+            )
+            conn.execute("COMMIT")
+            return now + ttl
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def release(self, node_id: str):
+        with closing(self._connect()) as conn:
+            conn.execute("DELETE FROM leases WHERE name = ? AND holder = ?", (self.lease_name, node_id))
+
+    def holder(self) -> Optional[Dict]:
+        with closing(self._connect()) as conn:
+            row = conn.execute("SELECT holder, expires_at FROM leases WHERE name = ?", (self.lease_name,)).fetchone()
+        if row is None or row[1] <= time.time():
+            return None
+        return {'node_id': row[0], 'expires_at': row[1]}
+
+
+class LeaderElector:
+    """
+    基于租约的主节点选举
+
+    后台任务每ttl/4尝试获取或续期租约，每次写入的租约有效期为ttl*3/4。主节点宕机时
+    租约最晚在ttl*3/4后过期，其他节点在随后ttl/4内的下一次尝试中接管，故障转移不超过ttl；
+    主节点在租约过期前还有两次续期机会，偶发的续期失败不会导致主节点切换。
+    """
+
+    def __init__(self, backend: LeaseBackend, node_id: str = None, ttl: float = 300):
+        self.backend = backend
+        self.node_id = node_id or f"{socket.gethostname()}-{os.getpid()}"
+        self.ttl = ttl
+        self.lease_duration = ttl * 3 / 4
+        self.heartbeat_interval = ttl / 4
+        self._expires_at = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    @property
+    def is_leader(self) -> bool:
+        """本节点当前是否持有有效租约"""
+        return time.time() < self._expires_at
+
+    async def refresh(self) -> bool:
+        """立即尝试获取或续期租约"""
+        was_leader = self.is_leader
+        try:
+            expires_at = await asyncio.to_thread(self.backend.try_acquire, self.node_id, self.lease_duration)
+        except Exception as e:
+            logger.warning(f"租约续期失败: {e}")
+            return self.is_leader
+        self._expires_at = expires_at or 0.0
+        if self.is_leader and not was_leader:
+            logger.info(f"👑 节点 {self.node_id} 成为主节点")
+        elif was_leader and not self.is_leader:
+            logger.warning(f"节点 {self.node_id} 失去主节点身份")
+        return self.is_leader
+
+    async def _heartbeat(self):
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.heartbeat_interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._heartbeat())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.is_leader:
+            self._expires_at = 0.0
+            await asyncio.to_thread(self.backend.release, self.node_id)
+            logger.info(f"节点 {self.node_id} 已释放租约")
+
+    async def current_holder(self) -> Optional[Dict]:
+        return await asyncio.to_thread(self.backend.holder)
+
+
+def create_lease_backend(backend: str, path: str) -> Optional[LeaseBackend]:
+    """根据配置创建租约后端，backend为none时返回None（单实例模式）"""
+    if not backend or backend == 'none':
+        return None
+    if not path:
+        raise ValueError("启用多实例协调时必须配置共享目录 coordination_path")
+    if backend == 'sqlite':
+        return SQLiteLeaseBackend(os.path.join(path, 'lease.db'))
+    raise ValueError(f"不支持的协调后端: {backend}")
+
+
+def publish_snapshot(store: ScanSnapshotStore, shared_dir: str, node_id: str) -> Optional[Dict]:
+    """
+    主节点把最新快照发布到共享目录
+
+    结果与元数据先写入独立的运行目录，再原子替换指针文件，从节点读到的结果与元数据总是同一次运行的。
+    """
+    meta = store.latest()
+    if meta is None:
+        return None
+    target_dir = os.path.join(shared_dir, SHARED_SNAPSHOT_DIR)
+    runs_dir = os.path.join(target_dir, 'runs')
+    os.makedirs(runs_dir, exist_ok=True)
+    meta = {**meta, 'leader': node_id}
+    run_dir = os.path.join(runs_dir, meta['run_id'])
+    if not os.path.isdir(run_dir):
+        tmp_dir = os.path.join(runs_dir, f".partial-{meta['run_id']}-{node_id}")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        shutil.copyfile(store.snapshot_result_path(meta['run_id']), os.path.join(tmp_dir, 'result.csv'))
+        with open(os.path.join(tmp_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta, f, ensure_ascii=False)
+        os.rename(tmp_dir, run_dir)
+    tmp_pointer = os.path.join(target_dir, f".{SHARED_POINTER_FILE}.{node_id}.tmp")
+    with open(tmp_pointer, 'w', encoding='utf-8') as f:
+        f.write(meta['run_id'])
+    os.replace(tmp_pointer, os.path.join(target_dir, SHARED_POINTER_FILE))
+    _prune_published(runs_dir, meta['run_id'])
+    logger.info(f"已发布快照到共享目录: {meta['run_id']}")
+    return meta
+
+
+def _prune_published(runs_dir: str, current: str):
+    """只保留最新的若干个已发布快照（运行ID按时间排序）"""
+    names = sorted(name for name in os.listdir(runs_dir) if not name.startswith('.'))
+    for name in names[:max(0, len(names) - SHARED_SNAPSHOT_RETENTION)]:
+        if name != current:
+            shutil.rmtree(os.path.join(runs_dir, name), ignore_errors=True)
+
+
+def sync_snapshot(store: ScanSnapshotStore, shared_dir: str) -> Optional[Dict]:
+    """
+    从节点导入主节点发布的快照（仅当比本地已导入的更新时）
+    :return: 新导入快照的元数据，没有新快照时返回None
+    """
+    source_dir = os.path.join(shared_dir, SHARED_SNAPSHOT_DIR)
+    try:
+        with open(os.path.join(source_dir, SHARED_POINTER_FILE), 'r', encoding='utf-8') as f:
+            run_dir = os.path.join(source_dir, 'runs', f.read().strip())
+        with open(os.path.join(run_dir, 'meta.json'), 'r', encoding='utf-8') as f:
+            leader_meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    latest = store.latest()
+    if latest is not None and leader_meta['run_id'] in (latest['run_id'], latest.get('source_run_id')):
+        return None
+
+    run = store.begin_run(leader_meta.get('args', []))
+    try:
+        shutil.copyfile(os.path.join(run_dir, 'result.csv'), run.result_path)
+        meta = store.commit(run, extra={'source_run_id': leader_meta['run_id'], 'leader': leader_meta.get('leader')})
+    except (OSError, ValueError) as e:
+        logger.warning(f"导入主节点快照失败: {e}")
+        return None
+    finally:
+        store.discard(run)
+    logger.info(f"已导入主节点 {leader_meta.get('leader')} 的快照: {leader_meta['run_id']}")
+    return meta
@@ -0,0 +1,164 @@
+import time
+import random
+import socket
+import struct
+import asyncio
+import ipaddress
+from typing import Dict, List, Tuple
+from astrbot.api import logger
+
+from .tracing import span
+
+QUERY_TYPES = {'A': 1, 'AAAA': 28}
+
+
+def encode_query(name: str, record_type: str, query_id: int) -> bytes:
+    """构造标准递归DNS查询报文"""
+    header = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0)
+    qname = b''.join(
+        bytes([len(label)]) + label for label in (part.encode('idna') for part in name.rstrip('.').split('.'))
+    ) + b'\x00'
+    return header + qname + struct.pack('!HH', QUERY_TYPES[record_type], 1)
+
+
+def _skip_name(data: bytes, offset: int) -> int:
+    """跳过报文中的域名（支持压缩指针），返回域名之后的偏移"""
+    while True:
+        length = data[offset]
+        if length & 0xC0 == 0xC0:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += length + 1
+
+
+def decode_response(data: bytes, query_id: int, record_type: str) -> Tuple[int, List[str]]:
+    """
+    解析DNS响应报文
+    :return: (响应码, 指定类型的应答地址列表)
+    :raises ValueError: 报文ID不匹配或格式错误
+    """
+    if len(data) < 12:
+        raise ValueError("DNS响应过短")
+    response_id, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', data[:12])
+    if response_id != query_id:
+        raise ValueError("DNS响应ID不匹配")
+    offset = 12
+    answers = []
+    qtype = QUERY_TYPES[record_type]
+    try:
+        for _ in range(qdcount):
+            offset = _skip_name(data, offset) + 4
+        for _ in range(ancount):
+            offset = _skip_name(data, offset)
+            rtype, _, _, rdlength = struct.unpack('!HHIH', data[offset:offset + 10])
+            offset += 10
+            rdata = data[offset:offset + rdlength]
+            offset += rdlength
+            if rtype == qtype:
+                answers.append(str(ipaddress.ip_address(rdata)))
+    except (IndexError, struct.error) as e:
+        # 截断或格式错误的报文
+        raise ValueError(f"DNS响应格式错误: {e}") from e
+    return flags & 0x000F, answers
+
+
+class _DNSQueryProtocol(asyncio.DatagramProtocol):
+    def __init__(self, query_id: int):
+        self.query_id = query_id
+        self.future = asyncio.get_running_loop().create_future()
+
+    def datagram_received(self, data: bytes, addr):
+        # 忽略ID不匹配的报文，继续等待
+        if not self.future.done() and len(data) >= 2 and struct.unpack('!H', data[:2])[0] == self.query_id:
+            self.future.set_result(data)
+
+    def error_received(self, exc: Exception):
+        if not self.future.done():
+            self.future.set_exception(exc)
+
+
+def parse_resolver(resolver: str) -> Tuple[str, int]:
+    """解析解析器地址，支持 1.1.1.1、1.1.1.1:53、[2606:4700::1111]:53"""
+    resolver = resolver.strip()
+    if resolver.startswith('['):
+        host, _, port = resolver[1:].partition(']')
+        return host, int(port.lstrip(':') or 53)
+    if resolver.count(':') == 1:
+        host, port = resolver.split(':')
+        return host, int(port)
+    return resolver, 53
+
+
+async def query(resolver: str, name: str, record_type: str, timeout: float = 2.0) -> List[str]:
+    """通过UDP向指定解析器查询记录，返回应答地址列表"""
+    host, port = parse_resolver(resolver)
+    query_id = random.randint(0, 0xFFFF)
+    loop = asyncio.get_running_loop()
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    transport, protocol = await loop.create_datagram_endpoint(
+        lambda: _DNSQueryProtocol(query_id), remote_addr=(host, port), family=family
+    )
+    try:
+        transport.sendto(encode_query(name, record_type, query_id))
+        data = await asyncio.wait_for(protocol.future, timeout)
+    finally:
+        transport.close()
+    rcode, answers = decode_response(data, query_id, record_type)
+    if rcode not in (0, 3):
+        raise ValueError(f"DNS响应错误码: {rcode}")
+    return answers
+
+
+class PropagationVerifier:
+    """
+    DNS传播验证
+
+    并发轮询多个解析器，直到全部返回预期地址或超过截止时间，
+    记录每个解析器的收敛耗时。
+    """
+
+    def __init__(self, resolvers: List[str], deadline: float = 300, interval: float = 5, query_timeout: float = 2):
+        self.resolvers = resolvers
+        self.deadline = deadline
+        self.interval = interval
+        self.query_timeout = query_timeout
+
+    async def _poll(self, resolver: str, name: str, record_type: str, expected: str, start: float) -> Dict:
+        result = {'converged': False, 'seconds': None, 'answers': [], 'queries': 0, 'error': None}
+        expected_address = ipaddress.ip_address(expected)
+        while True:
+            result['queries'] += 1
+            try:
+                result['answers'] = await query(resolver, name, record_type, self.query_timeout)
+                result['error'] = None
+                if any(ipaddress.ip_address(answer) == expected_address for answer in result['answers']):
+                    result['converged'] = True
+                    result['seconds'] = time.monotonic() - start
+                    return result
+            except (OSError, ValueError, asyncio.TimeoutError) as e:
+                result['error'] = str(e) or type(e).__name__
+            if time.monotonic() - start + self.interval > self.deadline:
+                return result
+            await asyncio.sleep(self.interval)
+
+    async def verify(self, name: str, record_type: str, expected: str) -> Dict[str, Dict]:
+        """
+        验证记录是否已在所有解析器上生效
+        :return: 解析器 -> 验证结果（converged、seconds、answers、queries、error）
+        """
+        if record_type not in QUERY_TYPES:
+            logger.info(f"记录类型 {record_type} 不支持传播验证，跳过")
+            return {}
+        start = time.monotonic()
+        with span('verify_propagation', resolvers=len(self.resolvers)):
+            results = await asyncio.gather(
+                *(self._poll(resolver, name, record_type, expected, start) for resolver in self.resolvers)
+            )
+        report = dict(zip(self.resolvers, results))
+        for resolver, result in report.items():
+            if result['converged']:
+                logger.info(f"✅ 解析器 {resolver} 已生效: {name} -> {expected} ({result['seconds']:.1f}秒)")
+            else:
+                logger.warning(f"❌ 解析器 {resolver} 在{self.deadline}秒内未生效, 最后应答: {result['answers']}, 错误: {result['error']}")
+        return report
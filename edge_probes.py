@@ -0,0 +1,256 @@
+import ssl
+import time
+import socket
+import asyncio
+import statistics
+import aiohttp
+from typing import Dict, List, Optional
+from aiohttp.abc import AbstractResolver
+from astrbot.api import logger
+
+from .latency_sketch import LatencySketch
+
+
+class PinnedResolver(AbstractResolver):
+    """把任意主机名解析到指定IP，使请求经由该IP发出，同时保留原URL的Host与SNI"""
+
+    def __init__(self, ip: str):
+        self.ip = ip
+        self.family = socket.AF_INET6 if ':' in ip else socket.AF_INET
+
+    async def resolve(self, host: str, port: int = 0, family: int = socket.AF_INET) -> List[Dict]:
+        return [{
+            'hostname': host,
+            'host': self.ip,
+            'port': port,
+            'family': self.family,
+            'proto': 0,
+            'flags': socket.AI_NUMERICHOST
+        }]
+
+    async def close(self) -> None:
+        pass
+
+
+class ThroughputTester:
+    """
+    异步下载速度测试
+
+    通过每个候选IP下载指定URL，按块流式读取且不缓存响应体，
+    单个IP的测试时间和下载字节数均有上限，并发数受信号量限制。
+    """
+
+    def __init__(self, url: str, concurrency: int = 4, max_seconds: float = 10,
+                 max_bytes: int = 50 * 1024 * 1024, chunk_size: int = 64 * 1024):
+        self.url = url
+        self.max_seconds = max_seconds
+        self.max_bytes = max_bytes
+        self.chunk_size = chunk_size
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def measure(self, ip: str) -> Dict:
+        """
+        通过指定IP测试下载速度
+        :return: 包含speed（MB/s）、ttfb_ms、bytes、seconds、error的结果字典
+        """
+        result = {'ip': ip, 'speed': 0.0, 'ttfb_ms': None, 'bytes': 0, 'seconds': 0.0, 'error': None}
+        async with self._semaphore:
+            connector = aiohttp.TCPConnector(resolver=PinnedResolver(ip), force_close=True, use_dns_cache=False)
+            timeout = aiohttp.ClientTimeout(total=None, sock_connect=min(5, self.max_seconds), sock_read=self.max_seconds)
+            start = time.monotonic()
+            deadline = start + self.max_seconds
+            first_byte = None
+            try:
+                async with aiohttp.ClientSession(connector=connector, timeout=timeout) as session:
+                    async with session.get(self.url) as response:
+                        response.raise_for_status()
+                        first_byte = time.monotonic()
+                        result['ttfb_ms'] = (first_byte - start) * 1000
+                        while result['bytes'] < self.max_bytes:
+                            remaining = deadline - time.monotonic()
+                            if remaining <= 0:
+                                break
+                            try:
+                                chunk = await asyncio.wait_for(response.content.read(self.chunk_size), remaining)
+                            except asyncio.TimeoutError:
+                                break
+                            if not chunk:
+                                break
+                            result['bytes'] += len(chunk)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                result['error'] = str(e) or type(e).__name__
+
+            if first_byte is not None:
+                result['seconds'] = time.monotonic() - first_byte
+                if result['seconds'] > 0:
+                    result['speed'] = result['bytes'] / result['seconds'] / (1024 * 1024)
+        return result
+
+    async def measure_many(self, ips: List[str]) -> List[Dict]:
+        """并发测试多个IP的下载速度"""
+        logger.info(f"开始下载测速: {len(ips)}个IP, URL: {self.url}")
+        results = await asyncio.gather(*(self.measure(ip) for ip in ips))
+        succeeded = [result for result in results if not result['error']]
+        logger.info(f"下载测速完成: 成功{len(succeeded)}/{len(results)}个IP")
+        return results
+
+
+class _FirstByteProtocol(asyncio.Protocol):
+    """记录首个响应数据到达时间的协议"""
+
+    def __init__(self):
+        loop = asyncio.get_running_loop()
+        self.first_byte = loop.create_future()
+        self.first_chunk = b''
+
+    def data_received(self, data: bytes):
+        if not self.first_byte.done():
+            self.first_chunk = data
+            self.first_byte.set_result(time.perf_counter())
+
+    def connection_lost(self, exc: Optional[Exception]):
+        if not self.first_byte.done():
+            self.first_byte.set_exception(exc or ConnectionResetError("连接在响应前关闭"))
+
+
+class TLSProber:
+    """
+    HTTPS延迟探测
+
+    直接连接候选IP，以指定域名作为TLS SNI与Host发起请求，分别测量TCP连接、
+    TLS握手和首字节时间（从发出请求到收到首个响应字节）。每个IP采样多次取中位数，
+    并发数受信号量限制。
+    """
+
+    def __init__(self, hostname: str, port: int = 443, path: str = '/', samples: int = 3,
+                 concurrency: int = 8, timeout: float = 5, ssl_context: ssl.SSLContext = None):
+        self.hostname = hostname
+        self.port = port
+        self.path = path or '/'
+        self.samples = max(1, samples)
+        self.timeout = timeout
+        self.ssl_context = ssl_context or ssl.create_default_context()
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def probe_once(self, ip: str) -> Dict:
+        """
+        单次探测
+        :return: 包含connect_ms、tls_ms、ttfb_ms、status的结果字典
+        """
+        loop = asyncio.get_running_loop()
+        transport = protocol = None
+        try:
+            start = time.perf_counter()
+            transport, protocol = await asyncio.wait_for(
+                loop.create_connection(_FirstByteProtocol, ip, self.port), self.timeout
+            )
+            connected = time.perf_counter()
+            transport = await asyncio.wait_for(
+                loop.start_tls(transport, protocol, self.ssl_context, server_hostname=self.hostname), self.timeout
+            )
+            handshaked = time.perf_counter()
+            transport.write(
+                f"GET {self.path} HTTP/1.1\r\nHost: {self.hostname}\r\n"
+                f"User-Agent: cloudflare-ip-optimizer\r\nConnection: close\r\n\r\n".encode('ascii')
+            )
+            first_byte = await asyncio.wait_for(protocol.first_byte, self.timeout)
+        finally:
+            if protocol is not None:
+                # 握手失败时连接关闭异常已写入future，取出以免被当作未处理异常
+                if not protocol.first_byte.done():
+                    protocol.first_byte.cancel()
+                elif not protocol.first_byte.cancelled():
+                    protocol.first_byte.exception()
+            if transport is not None:
+                transport.abort()
+        status_line = protocol.first_chunk.split(b'\r\n', 1)[0].split()
+        return {
+            'connect_ms': (connected - start) * 1000,
+            'tls_ms': (handshaked - connected) * 1000,
+            'ttfb_ms': (first_byte - handshaked) * 1000,
+            'status': int(status_line[1]) if len(status_line) > 1 and status_line[1].isdigit() else None
+        }
+
+    async def measure(self, ip: str) -> Dict:
+        """
+        对指定IP采样多次
+        :return: 各阶段耗时中位数（connect_ms、tls_ms、ttfb_ms、total_ms）、成功样本数、状态码与最后的错误
+        """
+        result = {'ip': ip, 'connect_ms': None, 'tls_ms': None, 'ttfb_ms': None, 'total_ms': None,
+                  'samples': 0, 'status': None, 'error': None}
+        probes = []
+        async with self._semaphore:
+            for _ in range(self.samples):
+                try:
+                    probes.append(await self.probe_once(ip))
+                except (OSError, ssl.SSLError, asyncio.TimeoutError) as e:
+                    result['error'] = str(e) or type(e).__name__
+        if probes:
+            for key in ('connect_ms', 'tls_ms', 'ttfb_ms'):
+                result[key] = statistics.median(probe[key] for probe in probes)
+            result['total_ms'] = statistics.median(
+                probe['connect_ms'] + probe['tls_ms'] + probe['ttfb_ms'] for probe in probes
+            )
+            result['samples'] = len(probes)
+            result['status'] = probes[-1]['status']
+        return result
+
+    async def measure_many(self, ips: List[str]) -> List[Dict]:
+        """并发探测多个IP"""
+        logger.info(f"开始HTTPS延迟探测: {len(ips)}个IP, SNI: {self.hostname}, 每个IP采样{self.samples}次")
+        results = await asyncio.gather(*(self.measure(ip) for ip in ips))
+        succeeded = [result for result in results if result['samples']]
+        logger.info(f"HTTPS延迟探测完成: 成功{len(succeeded)}/{len(results)}个IP")
+        return results
+
+
+class TCPPinger:
+    """
+    多样本TCP连接延迟采集
+
+    对每个IP重复建立TCP连接，连接耗时直接写入该IP的流式分位数草图而不保存样本，
+    用于得到p50/p95/p99与抖动。
+    """
+
+    def __init__(self, port: int = 443, samples: int = 10, interval: float = 0.2,
+                 concurrency: int = 16, timeout: float = 2):
+        self.port = port
+        self.samples = max(1, samples)
+        self.interval = interval
+        self.timeout = timeout
+        self._semaphore = asyncio.Semaphore(max(1, concurrency))
+
+    async def _connect_once(self, ip: str) -> float:
+        loop = asyncio.get_running_loop()
+        start = time.perf_counter()
+        transport, _ = await asyncio.wait_for(
+            loop.create_connection(asyncio.Protocol, ip, self.port), self.timeout
+        )
+        elapsed = (time.perf_counter() - start) * 1000
+        transport.abort()
+        return elapsed
+
+    async def measure(self, ip: str) -> Dict:
+        """
+        采集指定IP的连接延迟
+        :return: 包含sketch（LatencySketch）、sent、received的结果字典
+        """
+        sketch = LatencySketch()
+        sent = 0
+        async with self._semaphore:
+            for index in range(self.samples):
+                if index:
+                    await asyncio.sleep(self.interval)
+                sent += 1
+                try:
+                    sketch.add(await self._connect_once(ip))
+                except (OSError, asyncio.TimeoutError):
+                    continue
+        return {'ip': ip, 'sketch': sketch, 'sent': sent, 'received': sketch.count}
+
+    async def measure_many(self, ips: List[str]) -> List[Dict]:
+        """并发采集多个IP"""
+        logger.info(f"开始多样本延迟采集: {len(ips)}个IP, 每个IP {self.samples}次")
+        results = await asyncio.gather(*(self.measure(ip) for ip in ips))
+        logger.info(f"多样本延迟采集完成: {sum(result['received'] for result in results)}个有效样本")
+        return results
@@ -0,0 +1,153 @@
+import os
+import json
+import time
+import statistics
+from typing import Dict, List, Optional, Set
+from astrbot.api import logger
+
+# 一周的小时数，时段编号 = 星期(0为周一) * 24 + 小时
+SLOTS_PER_WEEK = 168
+WEEKDAYS = ['周一', '周二', '周三', '周四', '周五', '周六', '周日']
+
+
+def slot_of(timestamp: float = None) -> int:
+    """时间戳所在的周内小时时段（本地时间）"""
+    local = time.localtime(timestamp if timestamp is not None else time.time())
+    return local.tm_wday * 24 + local.tm_hour
+
+
+def slot_label(slot: int) -> str:
+    return f"{WEEKDAYS[slot // 24]} {slot % 24:02d}:00"
+
+
+def parse_peak_hours(value: str) -> Set[int]:
+    """把每天的高峰小时（如"19,20,21"）展开为一周内的时段"""
+    hours = set()
+    for token in (value or '').replace('，', ',').split(','):
+        token = token.strip()
+        if token.isdigit() and 0 <= int(token) < 24:
+            hours.add(int(token))
+    return {day * 24 + hour for day in range(7) for hour in hours}
+
+
+class HourlyLatencyModel:
+    """
+    按周内小时时段统计各IP的历史延迟
+
+    每次扫描把结果中延迟最低的top_k个IP计入扫描时所在的时段，时段内每个IP保存
+    指数加权平均延迟（衰减系数decay），并只保留最好的max_ips_per_slot个IP，
+    状态大小有上限。时段的"最优延迟"同样按指数加权平均，用于识别高峰时段。
+    """
+
+    def __init__(self, state_file: str, top_k: int = 20, max_ips_per_slot: int = 50,
+                 decay: float = 0.8, min_observations: int = 2, peak_factor: float = 1.2):
+        self.state_file = state_file
+        self.top_k = top_k
+        self.max_ips_per_slot = max_ips_per_slot
+        self.decay = decay
+        self.min_observations = min_observations
+        self.peak_factor = peak_factor
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict:
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            state.setdefault('slots', {})
+            state.setdefault('predictions', [])
+            return state
+        except (OSError, ValueError):
+            return {'slots': {}, 'predictions': []}
+
+    def save(self):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_file)
+
+    def _ewma(self, entry: List[float], value: float) -> List[float]:
+        """entry为[权重, 均值, 观测次数]"""
+        weight = entry[0] * self.decay + 1
+        mean = entry[1] + (value - entry[1]) / weight
+        return [weight, mean, entry[2] + 1]
+
+    def record(self, rows: List[Dict[str, str]], timestamp: float = None):
+        """把一次扫描的结果计入扫描时所在的时段"""
+        latencies = []
+        for row in rows:
+            try:
+                latencies.append((float(row.get('平均延迟', '')), row['IP 地址'].strip()))
+            except (ValueError, KeyError):
+                continue
+        if not latencies:
+            return
+        latencies.sort()
+        slot = self.state['slots'].setdefault(str(slot_of(timestamp)), {'best': [0.0, 0.0, 0], 'ips': {}})
+        slot['best'] = self._ewma(slot['best'], latencies[0][0])
+        for latency, ip in latencies[:self.top_k]:
+            slot['ips'][ip] = self._ewma(slot['ips'].get(ip, [0.0, 0.0, 0]), latency)
+        if len(slot['ips']) > self.max_ips_per_slot:
+            ranked = sorted(slot['ips'].items(), key=lambda item: item[1][1])
+            slot['ips'] = dict(ranked[:self.max_ips_per_slot])
+        self.save()
+
+    def predict(self, slot: int, limit: int = 10) -> List[Dict]:
+        """按历史平均延迟返回该时段表现最好的IP（至少观测min_observations次）"""
+        entries = self.state['slots'].get(str(slot), {}).get('ips', {})
+        ranked = sorted(
+            ((ip, entry) for ip, entry in entries.items() if entry[2] >= self.min_observations),
+            key=lambda item: item[1][1]
+        )
+        return [{'ip': ip, 'mean': entry[1], 'observations': entry[2]} for ip, entry in ranked[:limit]]
+
+    def peak_slots(self, configured: Set[int] = None) -> Set[int]:
+        """
+        高峰时段：优先使用配置的高峰小时；否则取最优延迟高于各时段中位数peak_factor倍的时段
+        （至少需要一天的时段有足够观测）
+        """
+        if configured:
+            return configured
+        bests = {
+            int(slot): data['best'][1] for slot, data in self.state['slots'].items()
+            if data['best'][2] >= self.min_observations
+        }
+        if len(bests) < 24:
+            return set()
+        threshold = statistics.median(bests.values()) * self.peak_factor
+        return {slot for slot, best in bests.items() if best > threshold}
+
+    @staticmethod
+    def next_window_start(after: float, peak_slots: Set[int]) -> Optional[float]:
+        """after之后（含after本身为整点的情况）最近一个高峰窗口的开始时间（整点），没有高峰时段时返回None"""
+        if not peak_slots:
+            return None
+        local = time.localtime(after)
+        hour_start = time.mktime(local[:4] + (0, 0) + local[6:9])
+        # after恰好是整点时，从该整点开始的窗口也算
+        first = 0 if hour_start == after else 1
+        for offset in range(first, SLOTS_PER_WEEK + first):
+            start = hour_start + offset * 3600
+            if slot_of(start) in peak_slots and slot_of(start - 3600) not in peak_slots:
+                return start
+        return None
+
+    def add_prediction(self, slot: int, ip: str, predicted_ms: float, window_start: float, keep: int = 20):
+        """记录一次预发布，观测值在高峰开始后通过set_observed补充"""
+        self.state['predictions'].append({
+            'slot': slot, 'ip': ip, 'predicted_ms': predicted_ms,
+            'window_start': window_start, 'observed_ms': None
+        })
+        self.state['predictions'] = self.state['predictions'][-keep:]
+        self.save()
+
+    def set_observed(self, window_start: float, ip: str, observed_ms: Optional[float]):
+        for prediction in reversed(self.state['predictions']):
+            if prediction['window_start'] == window_start and prediction['ip'] == ip:
+                prediction['observed_ms'] = observed_ms
+                self.save()
+                logger.info(f"高峰时段 {slot_label(prediction['slot'])} 预测 {prediction['predicted_ms']:.1f}ms, "
+                            f"实测 {observed_ms if observed_ms is not None else '无'}ms")
+                return
+
+    def recent_predictions(self, limit: int = 5) -> List[Dict]:
+        return list(reversed(self.state['predictions'][-limit:]))
@@ -0,0 +1,197 @@
+import time
+import asyncio
+import itertools
+from typing import Awaitable, Callable, Dict, List, Optional
+from astrbot.api import logger
+
+# 数值越小优先级越高：手动触发的任务先于定时任务执行
+PRIORITY_MANUAL = 0
+PRIORITY_SCHEDULED = 10
+
+STATUS_LABELS = {
+    'queued': '⏳ 排队中',
+    'running': '🔄 运行中',
+    'succeeded': '✅ 成功',
+    'failed': '❌ 失败',
+    'cancelled': '🚫 已取消'
+}
+
+
+class Job:
+    """一个后台任务，func为无参协程函数，返回值作为任务结果"""
+
+    def __init__(self, job_id: int, name: str, func: Callable[[], Awaitable], priority: int,
+                 on_done: Callable[['Job'], Awaitable] = None):
+        self.job_id = job_id
+        self.name = name
+        self.func = func
+        self.priority = priority
+        self.on_done = on_done
+        self.status = 'queued'
+        self.result = None
+        self.error: Optional[str] = None
+        self.created_at = time.time()
+        self.started_at: Optional[float] = None
+        self.finished_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+        self._cancel_requested = False
+        self._done = asyncio.Event()
+
+    @property
+    def finished(self) -> bool:
+        return self.status in ('succeeded', 'failed', 'cancelled')
+
+    @property
+    def wait_time(self) -> float:
+        """排队等待时长（秒）"""
+        return (self.started_at or self.finished_at or time.time()) - self.created_at
+
+    @property
+    def duration(self) -> Optional[float]:
+        """运行时长（秒），尚未开始时返回None"""
+        if self.started_at is None:
+            return None
+        return (self.finished_at or time.time()) - self.started_at
+
+    async def wait(self):
+        """等待任务结束"""
+        await self._done.wait()
+
+    def to_dict(self) -> Dict:
+        return {
+            'job_id': self.job_id,
+            'name': self.name,
+            'priority': self.priority,
+            'status': self.status,
+            'wait_time': self.wait_time,
+            'duration': self.duration,
+            'error': self.error
+        }
+
+
+class JobManager:
+    """
+    后台任务管理器
+
+    任务按优先级（相同优先级按提交顺序）进入队列，由固定数量的工作协程执行。
+    排队中的任务取消后直接跳过；运行中的任务取消时向其协程抛出CancelledError，
+    由任务自身负责清理（如终止扫描器子进程）。
+    """
+
+    def __init__(self, workers: int = 1, history: int = 50):
+        self.workers = max(1, workers)
+        self.history = history
+        self._jobs: Dict[int, Job] = {}
+        self._ids = itertools.count(1)
+        self._sequence = itertools.count()
+        self._queue: Optional[asyncio.PriorityQueue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self):
+        # 队列与工作协程在首次提交时创建，保证绑定到运行中的事件循环
+        if self._queue is None:
+            self._queue = asyncio.PriorityQueue()
+        if not self._worker_tasks:
+            self._worker_tasks = [
+                asyncio.create_task(self._worker(index)) for index in range(self.workers)
+            ]
+
+    def submit(self, name: str, func: Callable[[], Awaitable], priority: int = PRIORITY_MANUAL,
+               on_done: Callable[[Job], Awaitable] = None) -> Job:
+        """
+        提交任务并立即返回
+        :param func: 无参协程函数
+        :param on_done: 任务结束（含失败、取消）后调用的协程函数，参数为任务本身
+        """
+        self._ensure_workers()
+        job = Job(next(self._ids), name, func, priority, on_done)
+        self._jobs[job.job_id] = job
+        self._queue.put_nowait((priority, next(self._sequence), job))
+        logger.info(f"任务 #{job.job_id} ({name}) 已提交，优先级: {priority}，队列长度: {self._queue.qsize()}")
+        self._prune()
+        return job
+
+    def _prune(self):
+        finished = [job for job in self._jobs.values() if job.finished]
+        for job in finished[:max(0, len(finished) - self.history)]:
+            del self._jobs[job.job_id]
+
+    def get(self, job_id: int) -> Optional[Job]:
+        return self._jobs.get(job_id)
+
+    def list_jobs(self) -> List[Job]:
+        """按提交时间倒序返回任务"""
+        return sorted(self._jobs.values(), key=lambda job: job.job_id, reverse=True)
+
+    def cancel(self, job_id: int) -> bool:
+        """
+        取消任务
+        :return: 任务存在且尚未结束时返回True
+        """
+        job = self._jobs.get(job_id)
+        if job is None or job.finished:
+            return False
+        job._cancel_requested = True
+        if job.status == 'queued':
+            self._finish(job, 'cancelled')
+        elif job._task is not None:
+            job._task.cancel()
+        logger.info(f"任务 #{job_id} ({job.name}) 已请求取消")
+        return True
+
+    def _finish(self, job: Job, status: str, result=None, error: str = None):
+        job.status = status
+        job.result = result
+        job.error = error
+        job.finished_at = time.time()
+        job._done.set()
+
+    async def _worker(self, index: int):
+        while True:
+            _, _, job = await self._queue.get()
+            try:
+                if job.status != 'queued':
+                    continue
+                await self._run(job)
+                if job.on_done is not None:
+                    try:
+                        await job.on_done(job)
+                    except Exception as e:
+                        logger.warning(f"任务 #{job.job_id} 结束回调失败: {e}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job: Job):
+        job.status = 'running'
+        job.started_at = time.time()
+        logger.info(f"任务 #{job.job_id} ({job.name}) 开始执行，排队{job.wait_time:.1f}秒")
+        job._task = asyncio.create_task(job.func())
+        try:
+            result = await job._task
+        except asyncio.CancelledError:
+            self._finish(job, 'cancelled')
+            if not job._cancel_requested:
+                # 工作协程自身被取消（任务协程随之被取消），继续向上传播
+                raise
+        except Exception as e:
+            self._finish(job, 'failed', error=str(e) or type(e).__name__)
+        else:
+            self._finish(job, 'succeeded', result=result)
+        logger.info(f"任务 #{job.job_id} ({job.name}) {STATUS_LABELS[job.status]}，运行{job.duration:.1f}秒")
+
+    async def shutdown(self):
+        """取消所有排队和运行中的任务并停止工作协程"""
+        running = [job._task for job in self._jobs.values() if job.status == 'running' and job._task is not None]
+        for job in list(self._jobs.values()):
+            if not job.finished:
+                self.cancel(job.job_id)
+        # 等待运行中的任务完成清理（如终止扫描器子进程）
+        await asyncio.gather(*running, return_exceptions=True)
+        for task in self._worker_tasks:
+            task.cancel()
+        for task in self._worker_tasks:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+        self._worker_tasks = []
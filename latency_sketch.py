@@ -0,0 +1,94 @@
+import math
+from typing import Dict, Optional
+
+
+class LatencySketch:
+    """
+    流式分位数草图（对数分桶，DDSketch思路）
+
+    每个样本按相对误差alpha落入对数桶，分位数结果的相对误差不超过alpha；
+    桶数超过max_bins时合并最低的桶（只损失低分位精度，p95/p99不受影响），
+    因此无论样本多少，内存都是常数。抖动取相邻样本延迟差绝对值的平均值。
+    """
+
+    def __init__(self, alpha: float = 0.01, max_bins: int = 128):
+        self.alpha = alpha
+        self.max_bins = max_bins
+        self._gamma = (1 + alpha) / (1 - alpha)
+        self._log_gamma = math.log(self._gamma)
+        self.bins: Dict[int, int] = {}
+        self.count = 0
+        self.min: Optional[float] = None
+        self.max: Optional[float] = None
+        self._jitter_total = 0.0
+        self._jitter_count = 0
+        self._last: Optional[float] = None
+
+    def _index(self, value: float) -> int:
+        return math.ceil(math.log(max(value, 1e-3)) / self._log_gamma)
+
+    def add(self, value: float):
+        """加入一个延迟样本（毫秒）"""
+        index = self._index(value)
+        self.bins[index] = self.bins.get(index, 0) + 1
+        self.count += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+        if self._last is not None:
+            self._jitter_total += abs(value - self._last)
+            self._jitter_count += 1
+        self._last = value
+        if len(self.bins) > self.max_bins:
+            self._collapse()
+
+    @property
+    def jitter(self) -> Optional[float]:
+        """相邻样本延迟差绝对值的平均值，样本少于2个时返回None"""
+        if self._jitter_count == 0:
+            return None
+        return self._jitter_total / self._jitter_count
+
+    def _collapse(self):
+        indexes = sorted(self.bins)
+        overflow = len(indexes) - self.max_bins
+        target = indexes[overflow]
+        for index in indexes[:overflow]:
+            self.bins[target] += self.bins.pop(index)
+
+    def merge(self, other: 'LatencySketch'):
+        """合并另一个草图（抖动按各自的相邻样本差合并，不计入两个草图之间的差）"""
+        if other.count == 0:
+            return
+        for index, count in other.bins.items():
+            self.bins[index] = self.bins.get(index, 0) + count
+        self._jitter_total += other._jitter_total
+        self._jitter_count += other._jitter_count
+        self.count += other.count
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+        while len(self.bins) > self.max_bins:
+            self._collapse()
+
+    def quantile(self, q: float) -> Optional[float]:
+        """估计分位数（q取0~1），没有样本时返回None"""
+        if self.count == 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = 0
+        for index in sorted(self.bins):
+            seen += self.bins[index]
+            if seen > rank:
+                # 桶的代表值取对数中点，相对误差不超过alpha
+                value = 2 * self._gamma ** index / (self._gamma + 1)
+                return min(max(value, self.min), self.max)
+        return self.max
+
+    def summary(self) -> Dict[str, Optional[float]]:
+        """p50/p95/p99与抖动"""
+        return {
+            'p50': self.quantile(0.5),
+            'p95': self.quantile(0.95),
+            'p99': self.quantile(0.99),
+            'jitter': self.jitter,
+            'count': self.count
+        }
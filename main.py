@@ -1,18 +1,21 @@
 import os
+import time
 import asyncio
-from typing import Any, AsyncGenerator
+from typing import TYPE_CHECKING, Any, AsyncGenerator
 from astrbot.api import logger, AstrBotConfig
-from astrbot.api.event import AstrMessageEvent, filter
+from astrbot.api.event import AstrMessageEvent, MessageChain, filter
 from astrbot.api.star import Star, register, Context
 
-# 导入原有的功能模块
-from .cloudflare_optimizer import CloudflareIPOptimizer
-from .cloudflare_ddns import CloudflareDDNSUpdater
+# 功能模块（优选器、DDNS、任务队列、追踪等）都在首次使用时才导入，插件加载时只导入AstrBot接口
+if TYPE_CHECKING:
+    from .cloudflare_optimizer import CloudflareIPOptimizer
+    from .job_manager import JobManager
 
 @register("Cloudflare IP优化器", "cloudcranesss", "Cloudflare IP优选和DDNS更新插件", "1.0.0")
 class CloudflareIPOptimizerPlugin(Star):
     def __init__(self, context: Context, config: AstrBotConfig):
         super().__init__(context)
+        self.config = config
         
         # 获取配置
         self.cf_token = config.get("cf_token", "")
@@ -20,20 +23,110 @@ class CloudflareIPOptimizerPlugin(Star):
         self.main_domain = config.get("main_domain", "")
         self.sub_domain = config.get("sub_domain", "")
         self.record_type = config.get("record_type", "A")
+        self.verify_resolvers = [
+            resolver.strip() for resolver in config.get("verify_resolvers", "").split(",") if resolver.strip()
+        ]
         
         # 定时器配置
         self.enable_auto_update = config.get("enable_auto_update", False)
         self.auto_update_interval = config.get("auto_update_interval", 3600)  # 默认1小时
         self.auto_task = None
         
-        # 初始化优化器
-        self.optimizer = CloudflareIPOptimizer()
+        # 高峰前预选：按历史分时段统计在高峰开始前复测并预发布
+        self.enable_peak_prediction = config.get("enable_peak_prediction", False)
+        self.pre_peak_task = None
+        
+        # 多实例协调：启用后只有持有租约的主节点执行扫描和DDNS更新
+        self.coordination_backend = config.get("coordination_backend", "none")
+        self.coordination_path = config.get("coordination_path", "")
+        self.leader = None
+        
+        # 优化器与DDNS更新器在首次使用时创建
+        self._optimizer = None
+        self._ddns_updater = None
+        
+        # 耗时较长的优选与DDNS更新在后台任务队列中执行，命令立即返回任务ID（队列在首次提交任务时创建）
+        self._jobs = None
         
         logger.info("Cloudflare IP优化器插件已初始化")
         
         # 如果启用了自动更新，启动定时任务
         if self.enable_auto_update:
             asyncio.create_task(self.start_auto_update())
+
+    @property
+    def optimizer(self) -> "CloudflareIPOptimizer":
+        """IP优选器（首次访问时导入模块并创建）"""
+        if self._optimizer is None:
+            from .cloudflare_optimizer import CloudflareIPOptimizer
+            
+            self._optimizer = CloudflareIPOptimizer(config=self.config)
+        return self._optimizer
+
+    @property
+    def jobs(self) -> "JobManager":
+        """后台任务队列（首次访问时创建）"""
+        if self._jobs is None:
+            from .job_manager import JobManager
+            
+            self._jobs = JobManager(workers=self.config.get("job_workers", 1))
+        return self._jobs
+
+    def _trace_dir(self) -> str:
+        """追踪文件目录"""
+        return os.path.join(self.optimizer._get_cfst_dir(), 'traces')
+
+    @staticmethod
+    def _format_verification(verification: dict) -> str:
+        """格式化DNS传播验证结果"""
+        if not verification:
+            return ""
+        converged = [result for result in verification.values() if result["converged"]]
+        msg = f"\n\nDNS传播验证: {len(converged)}/{len(verification)}个解析器已生效\n"
+        for resolver, result in verification.items():
+            if result["converged"]:
+                msg += f"✅ {resolver} - {result['seconds']:.1f}秒\n"
+            else:
+                msg += f"❌ {resolver} - 未生效 (应答: {', '.join(result['answers']) or '无'})\n"
+        return msg
+
+    def _job_notifier(self, unified_msg_origin: str):
+        """创建任务结束回调：把任务结果发送回提交任务的会话"""
+        from .job_manager import STATUS_LABELS
+        
+        async def notify(job):
+            header = f"任务 #{job.job_id} ({job.name}) {STATUS_LABELS[job.status]}，耗时{job.duration or 0:.1f}秒"
+            if job.status == "succeeded":
+                text = f"{header}\n\n{job.result}"
+            elif job.status == "failed":
+                text = f"{header}\n原因: {job.error}"
+            else:
+                text = header
+            await self.context.send_message(unified_msg_origin, MessageChain().message(text))
+        return notify
+
+    def _get_ddns_updater(self):
+        """获取DDNS更新器（首次调用时导入模块并创建）"""
+        if self._ddns_updater is None:
+            from .cloudflare_ddns import CloudflareDDNSUpdater
+            
+            config = {
+                "cf_token": self.cf_token,
+                "zone_id": self.zone_id,
+                "main_domain": self.main_domain,
+                "sub_domain": self.sub_domain,
+                "record_type": self.record_type,
+                "result_file": "csft/result.csv",
+                "verify_resolvers": self.verify_resolvers,
+                "verify_timeout": self.config.get("verify_timeout", 300),
+                "selection_metric": self.config.get("selection_metric", "auto"),
+                "api_rate_limit": self.config.get("api_rate_limit", 1200),
+                "api_rate_window": self.config.get("api_rate_window", 300),
+                "api_burst": self.config.get("api_burst", 20)
+            }
+            logger.info(f"DDNS配置: {dict(config, cf_token='***')}")
+            self._ddns_updater = CloudflareDDNSUpdater(config)
+        return self._ddns_updater
         
     @filter.command_group("cf")
     async def cf_group(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
@@ -44,79 +137,92 @@ class CloudflareIPOptimizerPlugin(Star):
                 "  cf 优化 - 执行IP优选测试\n"
                 "  cf 更新 - 更新DDNS记录\n"
                 "  cf 状态 - 检查插件状态\n"
+                "  cf 任务 - 查看后台任务\n"
+                "  cf 取消 <任务ID> - 取消排队或运行中的任务\n"
                 "  cf 自动更新 - 切换自动更新状态\n"
-                "  cf 定时状态 - 查看自动更新状态"
+                "  cf 定时状态 - 查看自动更新状态\n"
+                "  cf 前缀 - 查看自适应采样的前缀预算分配\n"
+                "  cf 统计 [天数|机房 <地区码> [天数]|IP <地址>] - 查询历史扫描归档\n"
+                "  cf 性能分析 - 运行一次完整流程并输出耗时分析"
             )
             return
     
     @cf_group.command("优化")
     async def optimize_ip(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
-        """执行Cloudflare IP优选测试"""
+        """执行Cloudflare IP优选测试（后台任务）"""
+        from .job_manager import PRIORITY_MANUAL
+        
         logger.info("📞 收到cf优化命令请求")
         try:
-            yield event.plain_result("🚀 开始执行Cloudflare IP优选测试，请稍候...")
-            
-            # 检查工具状态
-            logger.info(f"检查工具路径: {self.optimizer.cloudflarespeedtest_path}")
-            tool_exists = os.path.exists(self.optimizer.cloudflarespeedtest_path)
-            logger.info(f"工具存在状态: {tool_exists}")
-            
-            if not tool_exists:
-                yield event.plain_result("📥 正在下载CloudflareSpeedTest工具...")
-                logger.info("开始下载CloudflareSpeedTest工具...")
-                download_success = await self.optimizer.download_cloudflarespeedtest()
-                if not download_success:
-                    logger.error("❌ 工具下载失败")
-                    yield event.plain_result("❌ 下载CloudflareSpeedTest工具失败")
-                    return
-                logger.info("✅ 工具下载成功")
-            else:
-                logger.info("✅ 工具已存在，跳过下载")
-            
-            # 执行IP优选测试
-            logger.info("开始执行IP优选测试...")
-            success = await self.optimizer.run_test()
-            
-            if success:
-                logger.info("✅ IP优选测试执行成功")
-                # 读取结果文件
-                result_file = os.path.join(self.optimizer._get_cfst_dir(), 'result.csv')
-                logger.info(f"尝试读取结果文件: {result_file}")
-                
-                if os.path.exists(result_file):
-                    import pandas as pd
-                    try:
-                        df = pd.read_csv(result_file)
-                        logger.info(f"结果文件读取成功，共{len(df)}条记录")
-                        
-                        # 按延迟排序并显示前5个结果
-                        df_sorted = df.sort_values(by='平均延迟').head(5)
-                        
-                        result_msg = "✅ IP优选测试完成！\n\n最优的5个IP:\n"
-                        for idx, row in df_sorted.iterrows():
-                            result_msg += f"{row['IP 地址']} - 延迟: {row['平均延迟']}ms - 速度: {row['下载速度(MB/s)']}MB/s\n"
-                        
-                        logger.info("准备返回测试结果给用户")
-                        yield event.plain_result(result_msg)
-                    except Exception as e:
-                        logger.error(f"读取结果文件失败: {e}")
-                        yield event.plain_result(f"✅ 测试完成，但读取结果失败: {str(e)}")
-                else:
-                    logger.warning("结果文件不存在")
-                    yield event.plain_result("✅ IP优选测试完成，但未找到结果文件")
-            else:
-                logger.error("❌ IP优选测试执行失败")
-                yield event.plain_result("❌ IP优选测试失败，请检查日志")
-                
+            job = self.jobs.submit("IP优选", self._optimize_job, PRIORITY_MANUAL,
+                                   on_done=self._job_notifier(event.unified_msg_origin))
+            yield event.plain_result(
+                f"🚀 已提交IP优选任务 #{job.job_id}，完成后将通知结果\n"
+                f"使用 cf 任务 查看进度，cf 取消 {job.job_id} 取消任务"
+            )
         except Exception as e:
             logger.error(f"❌ cf优化命令执行异常: {e}")
             import traceback
             logger.error(f"异常堆栈:\n{traceback.format_exc()}")
             yield event.plain_result(f"❌ 执行失败: {str(e)}")
 
+    async def _optimize_job(self) -> str:
+        """IP优选任务：必要时下载工具，执行测试并返回最优IP摘要"""
+        from .tracing import trace_run
+        
+        # 检查工具状态
+        logger.info(f"检查工具路径: {self.optimizer.cloudflarespeedtest_path}")
+        tool_exists = os.path.exists(self.optimizer.cloudflarespeedtest_path)
+        logger.info(f"工具存在状态: {tool_exists}")
+        
+        if not tool_exists:
+            logger.info("开始下载CloudflareSpeedTest工具...")
+            with trace_run('download_tool', self._trace_dir()):
+                download_success = await self.optimizer.download_cloudflarespeedtest()
+            if not download_success:
+                logger.error("❌ 工具下载失败")
+                raise RuntimeError("下载CloudflareSpeedTest工具失败")
+            logger.info("✅ 工具下载成功")
+        else:
+            logger.info("✅ 工具已存在，跳过下载")
+        
+        # 执行IP优选测试
+        logger.info("开始执行IP优选测试...")
+        with trace_run('optimize', self._trace_dir()):
+            success = await self.optimizer.run_test()
+        
+        if not success:
+            logger.error("❌ IP优选测试执行失败")
+            raise RuntimeError("IP优选测试失败，请检查日志")
+        
+        logger.info("✅ IP优选测试执行成功")
+        # 读取结果文件
+        result_file = self.optimizer.snapshots.result_path
+        logger.info(f"尝试读取结果文件: {result_file}")
+        
+        if not os.path.exists(result_file):
+            logger.warning("结果文件不存在")
+            return "✅ IP优选测试完成，但未找到结果文件"
+        try:
+            rows = self.optimizer.read_results(result_file)
+            logger.info(f"结果文件读取成功，共{len(rows)}条记录")
+            
+            # 按延迟排序并显示前5个结果
+            top_rows = self.optimizer.sort_by_latency(rows)[:5]
+            
+            result_msg = "✅ IP优选测试完成！\n\n最优的5个IP:\n"
+            for row in top_rows:
+                result_msg += f"{row['IP 地址']} - 延迟: {row['平均延迟']}ms - 速度: {row['下载速度(MB/s)']}MB/s\n"
+            return result_msg
+        except Exception as e:
+            logger.error(f"读取结果文件失败: {e}")
+            return f"✅ 测试完成，但读取结果失败: {str(e)}"
+
     @cf_group.command("更新")
     async def update_ddns(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
-        """更新Cloudflare DDNS记录"""
+        """更新Cloudflare DDNS记录（后台任务）"""
+        from .job_manager import PRIORITY_MANUAL
+        
         logger.info("📞 收到cf更新命令请求")
         try:
             # 检查必要配置
@@ -134,41 +240,12 @@ class CloudflareIPOptimizerPlugin(Star):
                 return
             
             logger.info("✅ 所有必要配置已设置")
-            yield event.plain_result("🔄 开始更新Cloudflare DDNS记录...")
-            
-            logger.info("✅ IP优选测试完成，准备更新DDNS")
-            
-            # 配置DDNS更新器
-            config = {
-                "cf_token": self.cf_token,
-                "zone_id": self.zone_id,
-                "main_domain": self.main_domain,
-                "sub_domain": self.sub_domain,
-                "record_type": self.record_type,
-                "result_file": "csft/result.csv"
-            }
-            
-            logger.info(f"DDNS配置: {config}")
-            ddns_updater = CloudflareDDNSUpdater(config)
-            
-            # 执行DDNS更新（异步）
-            logger.info("开始执行DDNS更新...")
-            yield event.plain_result("🔄 正在更新DDNS记录...")
-            update_success = await ddns_updater.update_ddns()
-            
-            if update_success:
-                logger.info("✅ DDNS更新成功")
-                best_ip = ddns_updater._get_lowest_latency_ip()
-                if best_ip:
-                    domain = f"{self.sub_domain}.{self.main_domain}" if self.sub_domain else self.main_domain
-                    logger.info(f"域名 {domain} 已更新为 IP: {best_ip}")
-                    yield event.plain_result(f"✅ DDNS更新成功！\n域名: {domain} -> IP: {best_ip}")
-                else:
-                    logger.info("DDNS更新成功，但无法获取最佳IP")
-                    yield event.plain_result("✅ DDNS更新成功！")
-            else:
-                logger.error("❌ DDNS更新失败")
-                yield event.plain_result("❌ DDNS更新失败")
+            job = self.jobs.submit("DDNS更新", self._update_job, PRIORITY_MANUAL,
+                                   on_done=self._job_notifier(event.unified_msg_origin))
+            yield event.plain_result(
+                f"🔄 已提交DDNS更新任务 #{job.job_id}，完成后将通知结果\n"
+                f"使用 cf 任务 查看进度，cf 取消 {job.job_id} 取消任务"
+            )
                 
         except Exception as e:
             logger.error(f"❌ cf更新命令执行异常: {e}")
@@ -176,6 +253,71 @@ class CloudflareIPOptimizerPlugin(Star):
             logger.error(f"异常堆栈:\n{traceback.format_exc()}")
             yield event.plain_result(f"❌ 更新失败: {str(e)}")
 
+    async def _update_job(self) -> str:
+        """DDNS更新任务：把记录更新为当前最优IP并返回传播验证结果"""
+        from .tracing import trace_run
+        
+        # 获取DDNS更新器
+        ddns_updater = self._get_ddns_updater()
+        
+        # 执行DDNS更新（异步）
+        logger.info("开始执行DDNS更新...")
+        with trace_run('update', self._trace_dir()):
+            update_success = await ddns_updater.update_ddns()
+        
+        if not update_success:
+            logger.error("❌ DDNS更新失败")
+            raise RuntimeError("DDNS更新失败")
+        
+        logger.info("✅ DDNS更新成功")
+        best_ip = ddns_updater._get_lowest_latency_ip()
+        if not best_ip:
+            logger.info("DDNS更新成功，但无法获取最佳IP")
+            return "✅ DDNS更新成功！"
+        domain = f"{self.sub_domain}.{self.main_domain}" if self.sub_domain else self.main_domain
+        logger.info(f"域名 {domain} 已更新为 IP: {best_ip}")
+        verification_msg = self._format_verification(ddns_updater.last_verification)
+        return f"✅ DDNS更新成功！\n域名: {domain} -> IP: {best_ip}{verification_msg}"
+
+    @cf_group.command("任务")
+    async def list_jobs(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
+        """查看后台任务状态"""
+        from .job_manager import STATUS_LABELS
+        
+        try:
+            jobs = self.jobs.list_jobs()[:10]
+            if not jobs:
+                yield event.plain_result("📋 暂无后台任务")
+                return
+            
+            status_msg = f"📋 后台任务（最近{len(jobs)}个，工作协程: {self.jobs.workers}个）:\n\n"
+            for job in jobs:
+                status_msg += f"#{job.job_id} {job.name} - {STATUS_LABELS[job.status]} - 排队{job.wait_time:.1f}秒"
+                if job.duration is not None:
+                    status_msg += f" - 运行{job.duration:.1f}秒"
+                if job.error:
+                    status_msg += f" - {job.error}"
+                status_msg += "\n"
+            
+            yield event.plain_result(status_msg)
+            
+        except Exception as e:
+            logger.error(f"查看后台任务失败: {e}")
+            yield event.plain_result(f"❌ 查看后台任务失败: {str(e)}")
+
+    @cf_group.command("取消")
+    async def cancel_job(self, event: AstrMessageEvent, job_id: int) -> AsyncGenerator[Any, None]:
+        """取消排队或运行中的后台任务（运行中的扫描器进程会被终止）"""
+        try:
+            if self.jobs.cancel(int(job_id)):
+                yield event.plain_result(f"🚫 已取消任务 #{job_id}")
+            else:
+                yield event.plain_result(f"❌ 任务 #{job_id} 不存在或已结束")
+                
+        except Exception as e:
+            logger.error(f"取消任务失败: {e}")
+            yield event.plain_result(f"❌ 取消任务失败: {str(e)}")
+
     @cf_group.command("状态")
     async def check_status(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
         """检查Cloudflare优化器状态"""
@@ -189,7 +331,7 @@ class CloudflareIPOptimizerPlugin(Star):
             
             # 检查工具状态
             tool_exists = os.path.exists(tool_path)
-            result_file = os.path.join(cfst_dir, 'result.csv')
+            result_file = self.optimizer.snapshots.result_path
             result_exists = os.path.exists(result_file)
             
             logger.info(f"工具存在: {tool_exists}")
@@ -203,13 +345,19 @@ class CloudflareIPOptimizerPlugin(Star):
             
             if result_exists:
                 file_size = os.path.getsize(result_file)
-                import time
                 file_time = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(os.path.getmtime(result_file)))
                 status_msg += f"结果文件: ✅ (大小: {file_size}字节, 时间: {file_time})\n"
                 logger.info(f"结果文件详情: 大小={file_size}字节, 修改时间={file_time}")
             else:
                 status_msg += "结果文件: ❌\n"
             
+            snapshots = self.optimizer.snapshots.list_snapshots()
+            latest = self.optimizer.snapshots.latest()
+            if latest:
+                finished = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(latest['finished_at']))
+                status_msg += f"最新快照: {latest['run_id']} ({latest['row_count']}条结果, 耗时{latest['duration']:.1f}秒, 完成于{finished})\n"
+                status_msg += f"保留快照: {len(snapshots)}个\n"
+            
             # Cloudflare配置状态
             cf_token_status = '✅' if self.cf_token else '❌'
             zone_id_status = '✅' if self.zone_id else '❌'
@@ -220,6 +368,18 @@ class CloudflareIPOptimizerPlugin(Star):
             status_msg += f"主域名: {self.main_domain or '未设置'}\n"
             status_msg += f"子域名: {self.sub_domain or '未设置'}\n"
             
+            # 高峰预测
+            if self.enable_peak_prediction:
+                status_msg += self._format_peak_prediction()
+            
+            # API调度状态
+            api_stats = self._ddns_updater.api.get_stats() if self._ddns_updater else None
+            if api_stats:
+                status_msg += f"\nAPI调度:\n"
+                status_msg += f"请求数: {api_stats['requests']} (重试: {api_stats['retries']}, 限流: {api_stats['throttled']}, 失败: {api_stats['failures']})\n"
+                status_msg += f"队列深度: {api_stats['queue_depth']}, 进行中: {api_stats['in_flight']}\n"
+                status_msg += f"排队等待: 平均 {api_stats['avg_wait']:.2f}秒, 最长 {api_stats['max_wait']:.2f}秒\n"
+            
             logger.info(f"配置状态 - Token: {cf_token_status}, Zone ID: {zone_id_status}")
             logger.info(f"配置状态 - 主域名: {self.main_domain}, 子域名: {self.sub_domain}")
             
@@ -232,6 +392,139 @@ class CloudflareIPOptimizerPlugin(Star):
             logger.error(f"异常堆栈:\n{traceback.format_exc()}")
             yield event.plain_result(f"❌ 获取状态失败: {str(e)}")
 
+    @cf_group.command("前缀")
+    async def prefix_allocation(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
+        """查看自适应采样的前缀预算分配"""
+        try:
+            sampler = self.optimizer.get_prefix_sampler()
+            report = sampler.report()
+            enabled = self.config.get("enable_adaptive_sampling", False)
+            
+            status_msg = "📊 前缀自适应采样:\n\n"
+            status_msg += f"自适应采样: {'✅ 已启用' if enabled else '❌ 已禁用'}\n"
+            status_msg += f"跟踪前缀: {len(sampler.state['prefixes'])}个\n"
+            if report:
+                status_msg += f"\n上一轮分配（前{len(report)}个前缀）:\n"
+                for row in report:
+                    status_msg += f"{row['prefix']} - 分配: {row['allocated']} - 平均收益: {row['mean_reward']:.2f} - 样本: {row['pulls']:.1f}\n"
+            else:
+                status_msg += "\n暂无分配记录"
+            
+            yield event.plain_result(status_msg)
+            
+        except Exception as e:
+            logger.error(f"查看前缀分配失败: {e}")
+            yield event.plain_result(f"❌ 查看前缀分配失败: {str(e)}")
+
+    @cf_group.command("统计")
+    async def archive_stats(self, event: AstrMessageEvent, query: str = "", value: str = "", days: int = 30) -> AsyncGenerator[Any, None]:
+        """查询历史扫描归档：概况、某机房每天的延迟中位数、某IP的获胜次数"""
+        try:
+            # 概况查询只带天数时（cf 统计 7），第一个参数即为天数
+            if query.isdigit():
+                query, days = "", int(query)
+            started = time.perf_counter()
+            with self.optimizer.get_scan_archive() as archive:
+                if archive.rows == 0:
+                    hint = "" if self.config.get("enable_scan_archive", False) else "（未启用enable_scan_archive）"
+                    yield event.plain_result(f"📈 暂无归档数据{hint}")
+                    return
+                
+                if query == "机房" and value:
+                    daily = archive.colo_daily(value.upper(), days)
+                    status_msg = f"📈 机房 {value.upper()} 最近{days}天延迟中位数:\n\n"
+                    for item in daily:
+                        status_msg += f"{item['day']} - {item['median']:.1f}ms ({item['rows']}条)\n"
+                    if not daily:
+                        status_msg += "无数据\n"
+                elif query.upper() == "IP" and value:
+                    stats = archive.ip_stats(value)
+                    status_msg = f"📈 IP {stats['ip']}:\n\n"
+                    status_msg += f"出现: {stats['appearances']}次 ({stats['runs']}/{stats['total_runs']}次运行)\n"
+                    status_msg += f"获胜: {stats['wins']}次 ({stats['wins'] / stats['total_runs'] * 100:.1f}%)\n"
+                    if stats['median'] is not None:
+                        status_msg += f"延迟: 中位数 {stats['median']:.1f}ms, 最低 {stats['best']:.1f}ms\n"
+                else:
+                    overview = archive.overview(days)
+                    first = time.strftime('%Y-%m-%d', time.localtime(overview['first']))
+                    last = time.strftime('%Y-%m-%d', time.localtime(overview['last']))
+                    status_msg = "📈 扫描归档统计:\n\n"
+                    status_msg += f"运行: {overview['runs']}次 ({first} ~ {last})\n"
+                    status_msg += f"结果: {overview['rows']}条, 占用 {overview['bytes'] / 1024 / 1024:.1f}MB\n"
+                    status_msg += f"\n最近{days}天机房（结果数 / 延迟中位数）:\n"
+                    for item in overview['colos'][:10]:
+                        median = f"{item['median']:.1f}ms" if item['median'] is not None else "无"
+                        status_msg += f"{item['colo']} - {item['rows']}条 / {median}\n"
+                    status_msg += f"\n最近{days}天获胜最多的IP:\n"
+                    for ip, wins in archive.top_winners(5, days):
+                        status_msg += f"{ip} - {wins}次\n"
+            
+            status_msg += f"\n查询耗时: {(time.perf_counter() - started) * 1000:.0f}ms"
+            yield event.plain_result(status_msg)
+            
+        except ValueError as e:
+            yield event.plain_result(f"❌ 参数无效: {str(e)}")
+        except Exception as e:
+            logger.error(f"❌ cf统计命令执行异常: {e}")
+            import traceback
+            logger.error(f"异常堆栈:\n{traceback.format_exc()}")
+            yield event.plain_result(f"❌ 查询统计失败: {str(e)}")
+
+    @cf_group.command("性能分析")
+    async def profile_pipeline(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
+        """在采样分析器下运行一次优选+DDNS流程，返回各阶段耗时与热点函数"""
+        from .job_manager import PRIORITY_MANUAL
+        
+        logger.info("📞 收到cf性能分析命令请求")
+        try:
+            # 与其他优选任务共用任务队列，避免同时运行两个扫描器
+            job = self.jobs.submit("性能分析", self._profile_job, PRIORITY_MANUAL)
+            yield event.plain_result(
+                f"🔬 已提交性能分析任务 #{job.job_id}，将完整执行一次IP优选流程，请稍候...\n"
+                f"使用 cf 取消 {job.job_id} 取消任务"
+            )
+            
+            await job.wait()
+            if job.status == "succeeded":
+                yield event.plain_result(job.result)
+            elif job.status == "failed":
+                yield event.plain_result(f"❌ 性能分析失败: {job.error}")
+            else:
+                yield event.plain_result(f"🚫 性能分析任务 #{job.job_id} 已取消")
+            
+        except Exception as e:
+            logger.error(f"❌ cf性能分析命令执行异常: {e}")
+            import traceback
+            logger.error(f"异常堆栈:\n{traceback.format_exc()}")
+            yield event.plain_result(f"❌ 性能分析失败: {str(e)}")
+
+    async def _profile_job(self) -> str:
+        """性能分析任务：在采样分析器下执行一次优选（已配置时包含DDNS更新），返回耗时分析"""
+        from .tracing import SamplingProfiler, trace_run
+        
+        profiler = SamplingProfiler()
+        profiler.start()
+        try:
+            with trace_run('profile', self._trace_dir()) as tracer:
+                success = await self.optimizer.run_test()
+                if success and all([self.cf_token, self.zone_id, self.main_domain]):
+                    await self._get_ddns_updater().update_ddns()
+        finally:
+            profiler.stop()
+        
+        total = tracer.root.duration
+        result_msg = f"🔬 性能分析完成（{'成功' if success else '失败'}），总耗时: {total:.2f}秒\n\n阶段耗时:\n"
+        for phase in tracer.phases()[:10]:
+            percent = phase['duration'] * 100 / total if total else 0
+            result_msg += f"{phase['name']} - {phase['duration'] * 1000:.0f}ms ({percent:.1f}%)\n"
+        
+        result_msg += (f"\n热点函数（采样{profiler.samples}次，其中{profiler.idle_samples}次事件循环空闲等待I/O，"
+                       f"已排除，百分比按其余{profiler.busy_samples}次计算）:\n")
+        for row in profiler.top(10):
+            result_msg += f"{row['function']} - 自身 {row['self_pct']:.1f}% - 累计样本 {row['total']}\n"
+        result_msg += f"\n追踪文件: {tracer.path}"
+        return result_msg
+
     async def start_auto_update(self):
         """启动自动更新定时任务"""
         if self.auto_task is not None:
@@ -239,7 +532,17 @@ class CloudflareIPOptimizerPlugin(Star):
             return
             
         logger.info(f"启动自动更新定时任务，间隔: {self.auto_update_interval}秒")
+        if self.coordination_backend != "none" and self.leader is None:
+            from .coordination import LeaderElector, create_lease_backend
+            
+            backend = create_lease_backend(self.coordination_backend, self.coordination_path)
+            self.leader = LeaderElector(backend, self.config.get("node_id") or None, self.config.get("lease_ttl", 300))
+            await self.leader.refresh()
+            self.leader.start()
+            logger.info(f"多实例协调已启用，节点: {self.leader.node_id}, 角色: {'主节点' if self.leader.is_leader else '从节点'}")
         self.auto_task = asyncio.create_task(self._auto_update_loop())
+        if self.enable_peak_prediction:
+            self.pre_peak_task = asyncio.create_task(self._pre_peak_loop())
 
     async def stop_auto_update(self):
         """停止自动更新定时任务"""
@@ -251,9 +554,27 @@ class CloudflareIPOptimizerPlugin(Star):
             except asyncio.CancelledError:
                 pass
             self.auto_task = None
+        if self.pre_peak_task is not None:
+            self.pre_peak_task.cancel()
+            try:
+                await self.pre_peak_task
+            except asyncio.CancelledError:
+                pass
+            self.pre_peak_task = None
+        if self.leader is not None:
+            await self.leader.stop()
+            self.leader = None
+
+    async def terminate(self):
+        """插件卸载时停止定时任务，取消所有后台任务（终止运行中的扫描器）"""
+        await self.stop_auto_update()
+        if self._jobs is not None:
+            await self._jobs.shutdown()
 
     async def _auto_update_loop(self):
         """自动更新循环任务"""
+        from .job_manager import PRIORITY_SCHEDULED
+        
         logger.info("自动更新循环任务已启动")
         
         while True:
@@ -266,33 +587,32 @@ class CloudflareIPOptimizerPlugin(Star):
                     logger.warning("自动更新缺少必要配置，跳过本次执行")
                     continue
                 
-                logger.info("🔄 开始执行定时IP优选和DDNS更新")
-                
-                # 执行IP优选测试
-                test_success = await self.optimizer.run_test()
-                if not test_success:
-                    logger.error("定时IP优选测试失败，跳过DDNS更新")
+                # 从节点不扫描，只导入主节点发布的快照
+                if self.leader is not None and not self.leader.is_leader:
+                    from .coordination import sync_snapshot
+                    
+                    meta = sync_snapshot(self.optimizer.snapshots, self.coordination_path)
+                    holder = await self.leader.current_holder()
+                    logger.info(f"当前为从节点（主节点: {holder['node_id'] if holder else '无'}），"
+                                f"{'已导入快照 ' + meta['run_id'] if meta else '无新快照'}，跳过扫描")
                     continue
                 
-                # 执行DDNS更新
-                config = {
-                    "cf_token": self.cf_token,
-                    "zone_id": self.zone_id,
-                    "main_domain": self.main_domain,
-                    "sub_domain": self.sub_domain,
-                    "record_type": self.record_type,
-                    "result_file": "csft/result.csv"
-                }
+                logger.info("🔄 提交定时IP优选和DDNS更新任务")
                 
-                ddns_updater = CloudflareDDNSUpdater(config)
-                update_success = await ddns_updater.update_ddns()
+                # 与手动命令共用任务队列，手动任务优先执行
+                job = self.jobs.submit("定时更新", self._scheduled_job, PRIORITY_SCHEDULED)
+                try:
+                    await job.wait()
+                except asyncio.CancelledError:
+                    self.jobs.cancel(job.job_id)
+                    raise
                 
-                if update_success:
-                    best_ip = ddns_updater._get_lowest_latency_ip()
-                    domain = f"{self.sub_domain}.{self.main_domain}" if self.sub_domain else self.main_domain
-                    logger.info(f"✅ 定时DDNS更新成功！{domain} -> {best_ip}")
+                if job.status == "succeeded":
+                    logger.info(job.result)
+                elif job.status == "failed":
+                    logger.error(f"❌ {job.error}")
                 else:
-                    logger.error("❌ 定时DDNS更新失败")
+                    logger.warning(f"定时更新任务 #{job.job_id} 已取消")
                     
             except asyncio.CancelledError:
                 logger.info("自动更新任务被取消")
@@ -304,6 +624,158 @@ class CloudflareIPOptimizerPlugin(Star):
                 # 发生异常时等待一段时间后重试，避免频繁重试
                 await asyncio.sleep(300)  # 等待5分钟
 
+    async def _scheduled_job(self) -> str:
+        """定时任务：执行IP优选测试，主节点发布快照并更新DDNS"""
+        from .tracing import trace_run
+        
+        with trace_run('auto_update', self._trace_dir()):
+            # 执行IP优选测试
+            test_success = await self.optimizer.run_test()
+            if test_success and self.leader is not None:
+                from .coordination import publish_snapshot
+                
+                publish_snapshot(self.optimizer.snapshots, self.coordination_path, self.leader.node_id)
+            # 扫描期间可能失去租约，写DNS前再次确认
+            still_leader = self.leader is None or await self.leader.refresh()
+            if test_success and still_leader:
+                # 执行DDNS更新
+                ddns_updater = self._get_ddns_updater()
+                update_success = await ddns_updater.update_ddns()
+        
+        if not test_success:
+            raise RuntimeError("定时IP优选测试失败，跳过DDNS更新")
+        if not still_leader:
+            logger.warning("扫描期间失去主节点身份，跳过DDNS更新")
+            return "扫描期间失去主节点身份，跳过DDNS更新"
+        if not update_success:
+            raise RuntimeError("定时DDNS更新失败")
+        
+        best_ip = ddns_updater._get_lowest_latency_ip()
+        domain = f"{self.sub_domain}.{self.main_domain}" if self.sub_domain else self.main_domain
+        return f"✅ 定时DDNS更新成功！{domain} -> {best_ip}"
+
+    def _next_peak(self, model, after: float = None):
+        """下一个高峰窗口的开始时间与所在时段，没有高峰时段时返回(None, None)"""
+        from .hourly_model import parse_peak_hours, slot_of
+        
+        peak_slots = model.peak_slots(parse_peak_hours(self.config.get("peak_hours", "")))
+        window_start = model.next_window_start(after or time.time(), peak_slots)
+        return window_start, (slot_of(window_start) if window_start is not None else None)
+
+    def _format_peak_prediction(self) -> str:
+        """格式化高峰预测：下一个高峰窗口的预测最优IP，以及近期预测与实测延迟的对比"""
+        from .hourly_model import slot_label
+        
+        model = self.optimizer.get_hourly_model()
+        window_start, slot = self._next_peak(model)
+        msg = "\n高峰预测:\n"
+        if window_start is None:
+            msg += "下一高峰: 未知（未配置高峰小时且历史数据不足）\n"
+        else:
+            msg += f"下一高峰: {time.strftime('%m-%d %H:%M', time.localtime(window_start))} ({slot_label(slot)})\n"
+            predicted = model.predict(slot, 1)
+            if predicted:
+                msg += f"预测最优: {predicted[0]['ip']} - {predicted[0]['mean']:.1f}ms ({predicted[0]['observations']}次观测)\n"
+            else:
+                msg += "预测最优: 该时段观测不足\n"
+        for prediction in model.recent_predictions(5):
+            observed = prediction['observed_ms']
+            msg += (f"{time.strftime('%m-%d %H:%M', time.localtime(prediction['window_start']))} {prediction['ip']} "
+                    f"预测 {prediction['predicted_ms']:.1f}ms / 实测 {f'{observed:.1f}ms' if observed is not None else '待测'}\n")
+        return msg
+
+    async def _pre_peak_loop(self):
+        """高峰前预选循环：在每个高峰窗口开始前pre_peak_lead秒复测历史优选IP并预发布"""
+        from .hourly_model import slot_label
+        from .job_manager import PRIORITY_SCHEDULED, STATUS_LABELS
+        
+        lead = self.config.get("pre_peak_lead", 900)
+        logger.info(f"高峰前预选任务已启动，提前: {lead}秒")
+        
+        while True:
+            try:
+                model = self.optimizer.get_hourly_model()
+                window_start, slot = self._next_peak(model, time.time() + lead)
+                if window_start is None:
+                    # 尚无高峰时段，等积累更多历史数据后再判断
+                    await asyncio.sleep(3600)
+                    continue
+                
+                await asyncio.sleep(max(0, window_start - lead - time.time()))
+                if not all([self.cf_token, self.zone_id, self.main_domain]):
+                    logger.warning("高峰前预选缺少必要配置，跳过本次执行")
+                    continue
+                if self.leader is not None and not self.leader.is_leader:
+                    logger.info("当前为从节点，跳过高峰前预选")
+                    continue
+                
+                logger.info(f"🔮 提交高峰前预选任务，高峰时段: {slot_label(slot)}")
+                job = self.jobs.submit("高峰预选", lambda: self._pre_peak_job(window_start), PRIORITY_SCHEDULED)
+                try:
+                    await job.wait()
+                except asyncio.CancelledError:
+                    self.jobs.cancel(job.job_id)
+                    raise
+                if job.status != "succeeded":
+                    logger.warning(f"高峰预选任务 #{job.job_id} {STATUS_LABELS[job.status]}: {job.error or ''}")
+                    continue
+                logger.info(job.result)
+                
+                # 高峰开始后实测已发布IP的延迟，与预测对比
+                await asyncio.sleep(max(0, window_start + 300 - time.time()))
+                await self._observe_peak(window_start)
+                    
+            except asyncio.CancelledError:
+                logger.info("高峰前预选任务被取消")
+                break
+            except Exception as e:
+                logger.error(f"高峰前预选任务执行异常: {e}")
+                import traceback
+                logger.error(f"异常堆栈:\n{traceback.format_exc()}")
+                await asyncio.sleep(300)
+
+    async def _pre_peak_job(self, window_start: float) -> str:
+        """高峰前预选任务：只复测该时段历史表现最好的IP，把预测最优且仍可用的IP发布到DDNS"""
+        from .hourly_model import slot_label, slot_of
+        from .tracing import trace_run
+        
+        model = self.optimizer.get_hourly_model()
+        slot = slot_of(window_start)
+        predicted = model.predict(slot, self.config.get("pre_peak_candidates", 20))
+        if not predicted:
+            return f"高峰时段 {slot_label(slot)} 历史观测不足，跳过预选"
+        
+        with trace_run('pre_peak', self._trace_dir()):
+            # 定向复测只用于选择本次发布的IP，不计入历史统计，也不替换当前结果
+            candidates = [item['ip'] for item in predicted]
+            if not await self.optimizer.run_test(candidates=candidates, record_history=False, publish=False):
+                raise RuntimeError("高峰前复测失败")
+            rows = self.optimizer.read_results(self.optimizer.last_result_path)
+            alive = {row.get('IP 地址', '').strip() for row in rows}
+            # 按历史排名选择本次复测仍可用的IP
+            chosen = next((item for item in predicted if item['ip'] in alive), None)
+            if chosen is None:
+                raise RuntimeError("历史优选IP均不可用")
+            if self.leader is not None and not await self.leader.refresh():
+                return "复测期间失去主节点身份，跳过预发布"
+            if not await self._get_ddns_updater().update_ddns(ip=chosen['ip']):
+                raise RuntimeError("预发布DDNS更新失败")
+        
+        model.add_prediction(slot, chosen['ip'], chosen['mean'], window_start)
+        return f"🔮 高峰 {slot_label(slot)} 已预发布 {chosen['ip']}（预测 {chosen['mean']:.1f}ms）"
+
+    async def _observe_peak(self, window_start: float):
+        """测量预发布IP在高峰时段的实际延迟"""
+        from .edge_probes import TCPPinger
+        
+        # 预测记录由预选任务写入，重新加载以读取最新状态
+        model = self.optimizer.get_hourly_model()
+        for prediction in model.recent_predictions(1):
+            if prediction['window_start'] != window_start:
+                return
+            result = await TCPPinger(samples=5).measure(prediction['ip'])
+            model.set_observed(window_start, prediction['ip'], result['sketch'].quantile(0.5))
+
     @cf_group.command("自动更新")
     async def toggle_auto_update(self, event: AstrMessageEvent) -> AsyncGenerator[Any, None]:
         """切换自动更新状态"""
@@ -333,6 +805,11 @@ class CloudflareIPOptimizerPlugin(Star):
             status_msg += f"自动更新: {'✅ 已启用' if self.enable_auto_update else '❌ 已禁用'}\n"
             status_msg += f"更新间隔: {self.auto_update_interval}秒 ({self.auto_update_interval//3600}小时{self.auto_update_interval%3600//60}分钟)\n"
             status_msg += f"定时任务: {'✅ 运行中' if self.auto_task and not self.auto_task.cancelled() else '❌ 未运行'}\n"
+            if self.leader is not None:
+                holder = await self.leader.current_holder()
+                status_msg += f"\n多实例协调: {self.coordination_backend}\n"
+                status_msg += f"本节点: {self.leader.node_id} ({'👑 主节点' if self.leader.is_leader else '从节点'})\n"
+                status_msg += f"当前主节点: {holder['node_id'] if holder else '无'}\n"
             
             yield event.plain_result(status_msg)
             
@@ -0,0 +1,224 @@
+import os
+import json
+import random
+import ipaddress
+from typing import Dict, List, Optional, Tuple
+from astrbot.api import logger
+
+# Cloudflare公开的IPv4地址段（cfst目录下没有ip.txt时使用）
+CLOUDFLARE_IPV4_RANGES = [
+    "173.245.48.0/20", "103.21.244.0/22", "103.22.200.0/22", "103.31.4.0/22",
+    "141.101.64.0/18", "108.162.192.0/18", "190.93.240.0/20", "188.114.96.0/20",
+    "197.234.240.0/22", "198.41.128.0/17", "162.158.0.0/15", "104.16.0.0/13",
+    "104.24.0.0/14", "172.64.0.0/13", "131.0.72.0/22"
+]
+CLOUDFLARE_IPV6_RANGES = [
+    "2400:cb00::/32", "2606:4700::/32", "2803:f800::/32", "2405:b500::/32",
+    "2405:8100::/32", "2a06:98c0::/29", "2c0f:f248::/32"
+]
+
+# 聚合粒度：IPv4按/24，IPv6按/48
+PREFIX_LENGTH = {4: 24, 6: 48}
+# Beta先验的等效样本数
+PRIOR_STRENGTH = 2.0
+
+
+def prefix_of(ip: str) -> str:
+    """获取IP所属的聚合前缀"""
+    address = ipaddress.ip_address(ip)
+    return str(ipaddress.ip_network(f"{address}/{PREFIX_LENGTH[address.version]}", strict=False))
+
+
+class PrefixBanditSampler:
+    """
+    基于前缀的自适应采样器（Thompson采样多臂老虎机）
+
+    每个/24（IPv4）或/48（IPv6）前缀视为一个臂，每个被测IP的收益为
+    (1 - 延迟/延迟上限) * (1 - 丢包率)，未出现在结果中的IP收益为0。
+    每轮从各前缀收益的Beta后验中抽样，按抽样值从高到低分配候选预算，
+    同时保留最低比例的均匀探索以发现新的前缀。
+    """
+
+    def __init__(self, state_file: str, ranges: List[str], exploration_ratio: float = 0.2,
+                 per_prefix_cap: int = 16, decay: float = 0.95):
+        """
+        :param state_file: 前缀统计持久化文件
+        :param ranges: 候选地址段（CIDR）
+        :param exploration_ratio: 均匀探索的最低预算比例
+        :param per_prefix_cap: 单个前缀每轮最多分配的IP数
+        :param decay: 每轮对历史统计的衰减系数，用于跟踪网络状况变化
+        """
+        self.state_file = state_file
+        self.exploration_ratio = min(1.0, max(0.0, exploration_ratio))
+        self.per_prefix_cap = max(1, per_prefix_cap)
+        self.decay = decay
+        self.ranges = []
+        for cidr in ranges:
+            try:
+                network = ipaddress.ip_network(cidr.strip(), strict=False)
+            except ValueError:
+                continue
+            length = PREFIX_LENGTH[network.version]
+            if network.prefixlen > length:
+                network = network.supernet(new_prefix=length)
+            self.ranges.append((network, 2 ** (length - network.prefixlen)))
+        self.state = self._load_state()
+
+    def _load_state(self) -> Dict:
+        try:
+            with open(self.state_file, 'r', encoding='utf-8') as f:
+                state = json.load(f)
+            state.setdefault('prefixes', {})
+            state.setdefault('last_allocation', {})
+            return state
+        except (OSError, ValueError):
+            return {'total_pulls': 0.0, 'prefixes': {}, 'last_allocation': {}}
+
+    def _save_state(self):
+        tmp_path = f"{self.state_file}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.state, f)
+        os.replace(tmp_path, self.state_file)
+
+    def _random_prefix(self) -> Optional[str]:
+        """从候选地址段中均匀随机选择一个前缀"""
+        if not self.ranges:
+            return None
+        network, count = random.choices(self.ranges, weights=[count for _, count in self.ranges])[0]
+        length = PREFIX_LENGTH[network.version]
+        offset = random.randrange(count) << (network.max_prefixlen - length)
+        base = ipaddress.ip_address(int(network.network_address) + offset)
+        return f"{base}/{length}"
+
+    def _base_rate(self) -> float:
+        """所有前缀的全局平均收益"""
+        prefixes = self.state['prefixes']
+        total_pulls = sum(pulls for pulls, _ in prefixes.values())
+        total_reward = sum(reward for _, reward in prefixes.values())
+        return min(0.99, max(0.01, total_reward / total_pulls)) if total_pulls else 0.5
+
+    def _thompson_draws(self, base_rate: float) -> List[Tuple[float, str]]:
+        """
+        从每个已知前缀的Beta后验中抽样，按抽样值降序返回
+        先验以全局平均收益为中心（经验贝叶斯），避免大量仅有少量样本的前缀抽到过高的值
+        """
+        alpha0, beta0 = base_rate * PRIOR_STRENGTH, (1 - base_rate) * PRIOR_STRENGTH
+        draws = []
+        for prefix, (pulls, reward) in self.state['prefixes'].items():
+            if pulls <= 0:
+                continue
+            draws.append((random.betavariate(alpha0 + reward, beta0 + max(0.0, pulls - reward)), prefix))
+        return sorted(draws, reverse=True)
+
+    def allocate(self, budget: int) -> Dict[str, int]:
+        """
+        为下一轮扫描分配候选预算
+        :return: 前缀 -> 分配的IP数量
+        """
+        allocation: Dict[str, int] = {}
+        base_rate = self._base_rate()
+        draws = self._thompson_draws(base_rate)
+        explore_budget = budget if not draws else max(1, int(budget * self.exploration_ratio))
+
+        # 利用：按后验抽样值从高到低为前缀分配预算，样本越多的前缀可分配越多（不超过上限），
+        # 避免偶然命中一次的前缀占用大量预算；抽样值不高于全局平均水平的前缀不值得加注，剩余预算转入探索
+        remaining = budget - explore_budget
+        for draw, prefix in draws:
+            if remaining <= 0 or draw <= base_rate:
+                break
+            pulls = self.state['prefixes'][prefix][0]
+            count = min(self.per_prefix_cap, remaining, max(2, int(pulls * 2)))
+            allocation[prefix] = count
+            remaining -= count
+
+        # 探索：剩余预算均匀分配到随机前缀，每个前缀一个IP
+        explore_budget += remaining
+        attempts = 0
+        while explore_budget > 0 and attempts < budget * 10:
+            attempts += 1
+            prefix = self._random_prefix()
+            if prefix is None:
+                break
+            if allocation.get(prefix, 0) >= self.per_prefix_cap:
+                continue
+            allocation[prefix] = allocation.get(prefix, 0) + 1
+            explore_budget -= 1
+        return allocation
+
+    @staticmethod
+    def sample_ips(allocation: Dict[str, int]) -> List[str]:
+        """在每个前缀内随机抽取指定数量的不重复主机地址"""
+        ips = []
+        for prefix, count in allocation.items():
+            network = ipaddress.ip_network(prefix)
+            host_count = network.num_addresses - 2 if network.version == 4 else network.num_addresses - 1
+            offsets = random.sample(range(1, host_count + 1), min(count, host_count)) if host_count < 2 ** 20 else \
+                {random.randrange(1, host_count + 1) for _ in range(count)}
+            ips.extend(str(network.network_address + offset) for offset in offsets)
+        return ips
+
+    def write_candidates(self, path: str, budget: int) -> List[str]:
+        """分配预算并写入候选IP文件（cfst -f 参数格式），返回候选IP列表"""
+        allocation = self.allocate(budget)
+        ips = self.sample_ips(allocation)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(ips) + '\n')
+        self.state['last_allocation'] = allocation
+        self._save_state()
+        logger.info(f"自适应采样: 预算{budget}, 分配到{len(allocation)}个前缀, 共{len(ips)}个候选IP")
+        return ips
+
+    def update(self, probed_ips: List[str], results: List[Dict[str, str]], latency_cap: float):
+        """根据本轮扫描结果更新前缀收益统计"""
+        rewards: Dict[str, float] = {}
+        for row in results:
+            try:
+                latency = float(row['平均延迟'])
+                loss = float(row.get('丢包率') or 0)
+            except (KeyError, ValueError):
+                continue
+            rewards[row['IP 地址'].strip()] = max(0.0, 1 - latency / latency_cap) * max(0.0, 1 - loss)
+
+        prefixes = self.state['prefixes']
+        for prefix in prefixes:
+            prefixes[prefix] = [value * self.decay for value in prefixes[prefix]]
+        self.state['total_pulls'] = self.state['total_pulls'] * self.decay
+        for ip in probed_ips:
+            prefix = prefix_of(ip)
+            pulls, reward = prefixes.get(prefix, [0.0, 0.0])
+            prefixes[prefix] = [pulls + 1, reward + rewards.get(ip, 0.0)]
+            self.state['total_pulls'] += 1
+
+        # 丢弃衰减到可以忽略的前缀，控制状态文件大小
+        for prefix in [prefix for prefix, (pulls, _) in prefixes.items() if pulls < 0.01]:
+            del prefixes[prefix]
+        self._save_state()
+        hits = sum(1 for ip in probed_ips if rewards.get(ip, 0) > 0)
+        logger.info(f"自适应采样统计已更新: 本轮{len(probed_ips)}个候选, 有效{hits}个, 跟踪前缀{len(prefixes)}个")
+
+    def report(self, limit: int = 10) -> List[Dict]:
+        """上一轮各前缀的预算分配情况（按分配数量降序）"""
+        allocation = self.state.get('last_allocation', {})
+        rows = []
+        for prefix, count in sorted(allocation.items(), key=lambda item: item[1], reverse=True)[:limit]:
+            pulls, reward = self.state['prefixes'].get(prefix, [0.0, 0.0])
+            rows.append({
+                'prefix': prefix,
+                'allocated': count,
+                'pulls': pulls,
+                'mean_reward': reward / pulls if pulls else 0.0
+            })
+        return rows
+
+    @staticmethod
+    def load_ranges(cfst_dir: str, ipv6: bool = False) -> List[str]:
+        """读取cfst自带的地址段文件，不存在时使用内置的Cloudflare地址段"""
+        path = os.path.join(cfst_dir, 'ipv6.txt' if ipv6 else 'ip.txt')
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                ranges = [line.strip() for line in f if line.strip() and not line.startswith('#')]
+            if ranges:
+                return ranges
+        except OSError:
+            pass
+        return CLOUDFLARE_IPV6_RANGES if ipv6 else CLOUDFLARE_IPV4_RANGES
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import bisect
+import hashlib
+import ipaddress
+from typing import Dict, Iterable, List, Optional, Tuple
+from astrbot.api import logger
+
+from .tracing import span
+
+# Cloudflare官方发布的地址段列表
+DEFAULT_FEED_URLS = [
+    "https://www.cloudflare.com/ips-v4",
+    "https://www.cloudflare.com/ips-v6"
+]
+
+
+def parse_ranges(text: str) -> List[ipaddress._BaseNetwork]:
+    """解析地址段文本：每行（或逗号、空白分隔）一个CIDR或单个IP，#开头为注释"""
+    networks = []
+    for line in text.splitlines():
+        line = line.split('#', 1)[0]
+        for token in line.replace(',', ' ').split():
+            try:
+                networks.append(ipaddress.ip_network(token, strict=False))
+            except ValueError:
+                logger.debug(f"忽略无效的地址段: {token}")
+    return networks
+
+
+class IntervalIndex:
+    """
+    地址区间索引
+
+    把地址段合并为按起始地址排序、互不重叠的整数区间（IPv4与IPv6分开存放），
+    成员查询通过二分查找完成，复杂度O(log n)。
+    """
+
+    def __init__(self, intervals: Dict[int, List[Tuple[int, int]]] = None):
+        intervals = intervals or {}
+        self._starts = {version: [start for start, _ in intervals.get(version, [])] for version in (4, 6)}
+        self._ends = {version: [end for _, end in intervals.get(version, [])] for version in (4, 6)}
+
+    @staticmethod
+    def _merge(intervals: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        merged: List[Tuple[int, int]] = []
+        for start, end in sorted(intervals):
+            if merged and start <= merged[-1][1] + 1:
+                merged[-1] = (merged[-1][0], max(merged[-1][1], end))
+            else:
+                merged.append((start, end))
+        return merged
+
+    @staticmethod
+    def _subtract(intervals: List[Tuple[int, int]], removed: List[Tuple[int, int]]) -> List[Tuple[int, int]]:
+        """从已合并的区间中减去已合并的排除区间"""
+        result = []
+        index = 0
+        for start, end in intervals:
+            while index < len(removed) and removed[index][1] < start:
+                index += 1
+            cursor = start
+            scan = index
+            while scan < len(removed) and removed[scan][0] <= end:
+                if removed[scan][0] > cursor:
+                    result.append((cursor, removed[scan][0] - 1))
+                cursor = max(cursor, removed[scan][1] + 1)
+                scan += 1
+            if cursor <= end:
+                result.append((cursor, end))
+        return result
+
+    @classmethod
+    def build(cls, include: Iterable[ipaddress._BaseNetwork],
+              exclude: Iterable[ipaddress._BaseNetwork] = ()) -> 'IntervalIndex':
+        """由包含与排除地址段构建索引"""
+        def to_intervals(networks):
+            grouped: Dict[int, List[Tuple[int, int]]] = {4: [], 6: []}
+            for network in networks:
+                grouped[network.version].append((int(network.network_address), int(network.broadcast_address)))
+            return {version: cls._merge(items) for version, items in grouped.items()}
+
+        included = to_intervals(include)
+        excluded = to_intervals(exclude)
+        return cls({version: cls._subtract(included[version], excluded[version]) for version in (4, 6)})
+
+    def __contains__(self, ip) -> bool:
+        try:
+            address = ipaddress.ip_address(ip.strip() if isinstance(ip, str) else ip)
+        except ValueError:
+            return False
+        value = int(address)
+        starts = self._starts[address.version]
+        position = bisect.bisect_right(starts, value) - 1
+        return position >= 0 and value <= self._ends[address.version][position]
+
+    def __len__(self) -> int:
+        return sum(len(starts) for starts in self._starts.values())
+
+    def num_addresses(self, version: int) -> int:
+        return sum(end - start + 1 for start, end in zip(self._starts[version], self._ends[version]))
+
+    def networks(self, version: int) -> List[str]:
+        """把区间还原为最少数量的CIDR列表"""
+        address_class = ipaddress.IPv4Address if version == 4 else ipaddress.IPv6Address
+        networks = []
+        for start, end in zip(self._starts[version], self._ends[version]):
+            networks.extend(
+                str(network) for network in ipaddress.summarize_address_range(address_class(start), address_class(end))
+            )
+        return networks
+
+
+class RangeFeedCache:
+    """
+    地址段订阅源缓存
+
+    拉取的列表保存在本地磁盘，按刷新间隔使用ETag/If-Modified-Since条件请求更新，
+    请求失败或内容无效时继续使用已缓存的版本。
+    """
+
+    def __init__(self, cache_dir: str, urls: List[str], refresh_interval: float = 86400):
+        self.cache_dir = cache_dir
+        self.urls = urls
+        self.refresh_interval = refresh_interval
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def _paths(self, url: str) -> Tuple[str, str]:
+        key = hashlib.sha1(url.encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.cache_dir, f"{key}.txt"), os.path.join(self.cache_dir, f"{key}.meta.json")
+
+    def _read_meta(self, url: str) -> Dict:
+        try:
+            with open(self._paths(url)[1], 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    @staticmethod
+    def _write_atomic(path: str, content: str):
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+        os.replace(tmp_path, path)
+
+    async def _refresh_one(self, session, url: str, force: bool) -> bool:
+        import aiohttp
+
+        data_path, meta_path = self._paths(url)
+        meta = self._read_meta(url)
+        if not force and os.path.exists(data_path) and time.time() - meta.get('fetched_at', 0) < self.refresh_interval:
+            return False
+
+        headers = {}
+        if os.path.exists(data_path):
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        try:
+            async with session.get(url, headers=headers, timeout=aiohttp.ClientTimeout(total=15)) as response:
+                if response.status == 304:
+                    logger.debug(f"地址段订阅未变化: {url}")
+                    meta['fetched_at'] = time.time()
+                    self._write_atomic(meta_path, json.dumps(meta))
+                    return False
+                response.raise_for_status()
+                text = await response.text()
+                etag = response.headers.get('ETag')
+                last_modified = response.headers.get('Last-Modified')
+        except Exception as e:
+            logger.warning(f"拉取地址段订阅失败，继续使用缓存: {url} - {e}")
+            return False
+
+        networks = parse_ranges(text)
+        if not networks:
+            logger.warning(f"地址段订阅内容无效，继续使用缓存: {url}")
+            return False
+        self._write_atomic(data_path, text)
+        self._write_atomic(meta_path, json.dumps({
+            'url': url, 'etag': etag, 'last_modified': last_modified,
+            'fetched_at': time.time(), 'count': len(networks)
+        }))
+        logger.info(f"地址段订阅已更新: {url} ({len(networks)}个地址段)")
+        return True
+
+    async def refresh(self, force: bool = False) -> bool:
+        """刷新所有订阅源，返回是否有内容变化"""
+        import aiohttp
+
+        with span('refresh_range_feeds', feeds=len(self.urls)):
+            async with aiohttp.ClientSession() as session:
+                changed = [await self._refresh_one(session, url, force) for url in self.urls]
+        return any(changed)
+
+    def load(self) -> List[ipaddress._BaseNetwork]:
+        """读取所有已缓存订阅源的地址段"""
+        networks = []
+        for url in self.urls:
+            try:
+                with open(self._paths(url)[0], 'r', encoding='utf-8') as f:
+                    networks.extend(parse_ranges(f.read()))
+            except OSError:
+                continue
+        return networks
+
+
+def build_range_index(feed_networks: Iterable[ipaddress._BaseNetwork], allowlist: str = '',
+                      denylist: str = '') -> IntervalIndex:
+    """合并订阅源与本地允许列表，并减去拒绝列表，构建区间索引"""
+    include = list(feed_networks) + parse_ranges(allowlist)
+    return IntervalIndex.build(include, parse_ranges(denylist))
+
+
+def load_list(value: Optional[str], base_dir: str) -> str:
+    """本地允许/拒绝列表既可以直接填写地址段，也可以填写文件路径"""
+    if not value:
+        return ''
+    path = value if os.path.isabs(value) else os.path.join(base_dir, value)
+    if os.path.isfile(path):
+        with open(path, 'r', encoding='utf-8') as f:
+            return f.read()
+    return value
+
+
+def list_signature(value: Optional[str], base_dir: str) -> Tuple[str, Optional[float]]:
+    """列表的缓存键：配置值与列表文件的修改时间（直接填写地址段时为None），文件被编辑后键随之变化"""
+    if not value:
+        return '', None
+    path = value if os.path.isabs(value) else os.path.join(base_dir, value)
+    try:
+        return value, os.path.getmtime(path)
+    except OSError:
+        return value, None
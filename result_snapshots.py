@@ -0,0 +1,192 @@
+import os
+import csv
+import json
+import time
+import uuid
+import shutil
+import ipaddress
+from typing import Dict, List, Optional
+from astrbot.api import logger
+
+RESULT_FILE_NAME = 'result.csv'
+META_FILE_NAME = 'meta.json'
+LATEST_POINTER = 'LATEST'
+PARTIAL_PREFIX = '.partial-'
+# 超过该时长的未完成运行视为进程崩溃遗留
+STALE_PARTIAL_SECONDS = 24 * 3600
+
+
+class ScanRun:
+    """一次进行中的扫描运行"""
+
+    def __init__(self, run_id: str, run_dir: str, args: List[str]):
+        self.run_id = run_id
+        self.run_dir = run_dir
+        self.args = list(args)
+        self.started_at = time.time()
+        self.committed = False
+
+    @property
+    def result_path(self) -> str:
+        return os.path.join(self.run_dir, RESULT_FILE_NAME)
+
+
+class ScanSnapshotStore:
+    """
+    扫描结果快照存储
+
+    每次扫描写入独立的运行目录（runs/.partial-<id>），校验通过后通过重命名提交为
+    runs/<id>，并用os.replace原子替换cfst目录下的result.csv和LATEST指针。
+    读取方只会看到完整的已提交快照，永远不会读到进行中或失败的运行。
+    """
+
+    def __init__(self, base_dir: str, retention: int = 10):
+        """
+        :param base_dir: cfst目录，发布的result.csv位于此目录
+        :param retention: 保留的已提交快照数量
+        """
+        self.base_dir = base_dir
+        self.runs_dir = os.path.join(base_dir, 'runs')
+        self.retention = max(1, retention)
+
+    @property
+    def result_path(self) -> str:
+        """当前已发布的结果文件路径"""
+        return os.path.join(self.base_dir, RESULT_FILE_NAME)
+
+    def begin_run(self, args: List[str]) -> ScanRun:
+        """创建新的运行目录"""
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:6]}"
+        run_dir = os.path.join(self.runs_dir, PARTIAL_PREFIX + run_id)
+        os.makedirs(run_dir, exist_ok=True)
+        logger.info(f"创建扫描运行目录: {run_dir}")
+        return ScanRun(run_id, run_dir, args)
+
+    @staticmethod
+    def validate(result_path: str) -> int:
+        """
+        校验结果文件是否完整有效
+        :return: 有效数据行数
+        :raises ValueError: 文件缺失、表头不符或没有有效数据行
+        """
+        if not os.path.exists(result_path) or os.path.getsize(result_path) == 0:
+            raise ValueError("结果文件不存在或为空")
+        with open(result_path, 'r', encoding='utf-8-sig', newline='') as f:
+            reader = csv.DictReader(f)
+            if not reader.fieldnames or 'IP 地址' not in reader.fieldnames or '平均延迟' not in reader.fieldnames:
+                raise ValueError(f"结果文件表头无效: {reader.fieldnames}")
+            row_count = 0
+            for row in reader:
+                try:
+                    ipaddress.ip_address((row.get('IP 地址') or '').strip())
+                    float(row.get('平均延迟') or '')
+                except ValueError:
+                    raise ValueError(f"结果文件包含无效行: {row}")
+                row_count += 1
+        if row_count == 0:
+            raise ValueError("结果文件没有有效数据行")
+        return row_count
+
+    def commit(self, run: ScanRun, extra: Optional[Dict] = None, publish: bool = True) -> Dict:
+        """
+        校验并原子提交运行结果
+        :param extra: 附加写入元数据的字段
+        :param publish: 是否发布为当前结果（更新result.csv与LATEST指针）；为False时只保存快照，
+                        如高峰前定向复测的结果只用于选择本次预发布的IP，不替换当前结果
+        :return: 快照元数据
+        :raises ValueError: 结果文件校验失败
+        """
+        row_count = self.validate(run.result_path)
+        finished_at = time.time()
+        meta = {
+            'run_id': run.run_id,
+            'started_at': run.started_at,
+            'finished_at': finished_at,
+            'duration': finished_at - run.started_at,
+            'args': run.args,
+            'row_count': row_count,
+            **(extra or {})
+        }
+        self._write_atomic(os.path.join(run.run_dir, META_FILE_NAME), json.dumps(meta, ensure_ascii=False, indent=2))
+
+        final_dir = os.path.join(self.runs_dir, run.run_id)
+        os.replace(run.run_dir, final_dir)
+        run.run_dir = final_dir
+        run.committed = True
+
+        if publish:
+            # 先发布结果文件，再移动LATEST指针
+            tmp_path = os.path.join(self.base_dir, f".{RESULT_FILE_NAME}.{run.run_id}.tmp")
+            shutil.copyfile(run.result_path, tmp_path)
+            os.replace(tmp_path, self.result_path)
+            self._write_atomic(os.path.join(self.runs_dir, LATEST_POINTER), run.run_id)
+            logger.info(f"✅ 快照已发布: {run.run_id} ({row_count}条结果, 耗时{meta['duration']:.1f}秒)")
+        else:
+            logger.info(f"快照已保存（未发布）: {run.run_id} ({row_count}条结果, 耗时{meta['duration']:.1f}秒)")
+
+        self._prune()
+        return meta
+
+    def discard(self, run: ScanRun):
+        """丢弃未提交的运行"""
+        if run.committed:
+            return
+        shutil.rmtree(run.run_dir, ignore_errors=True)
+        logger.info(f"已丢弃未完成的扫描运行: {run.run_id}")
+
+    def latest(self) -> Optional[Dict]:
+        """获取最新已提交快照的元数据"""
+        try:
+            with open(os.path.join(self.runs_dir, LATEST_POINTER), 'r', encoding='utf-8') as f:
+                run_id = f.read().strip()
+        except FileNotFoundError:
+            return None
+        return self._read_meta(run_id)
+
+    def list_snapshots(self) -> List[Dict]:
+        """列出所有已提交快照的元数据（最新在前）"""
+        if not os.path.isdir(self.runs_dir):
+            return []
+        snapshots = []
+        for name in os.listdir(self.runs_dir):
+            if name.startswith('.') or name.startswith(LATEST_POINTER):
+                continue
+            meta = self._read_meta(name)
+            if meta:
+                snapshots.append(meta)
+        return sorted(snapshots, key=lambda meta: meta['finished_at'], reverse=True)
+
+    def snapshot_result_path(self, run_id: str) -> str:
+        """获取指定快照的结果文件路径"""
+        return os.path.join(self.runs_dir, run_id, RESULT_FILE_NAME)
+
+    def _read_meta(self, run_id: str) -> Optional[Dict]:
+        try:
+            with open(os.path.join(self.runs_dir, run_id, META_FILE_NAME), 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def _prune(self):
+        """清理超出保留数量的旧快照以及遗留的未完成运行（当前发布的快照始终保留）"""
+        latest = self.latest()
+        for meta in self.list_snapshots()[self.retention:]:
+            if latest is not None and meta['run_id'] == latest['run_id']:
+                continue
+            shutil.rmtree(os.path.join(self.runs_dir, meta['run_id']), ignore_errors=True)
+            logger.debug(f"清理旧快照: {meta['run_id']}")
+        now = time.time()
+        for name in os.listdir(self.runs_dir):
+            path = os.path.join(self.runs_dir, name)
+            if name.startswith(PARTIAL_PREFIX) and now - os.path.getmtime(path) > STALE_PARTIAL_SECONDS:
+                shutil.rmtree(path, ignore_errors=True)
+                logger.debug(f"清理遗留的未完成运行: {name}")
+
+    @staticmethod
+    def _write_atomic(path: str, content: str):
+        tmp_path = f"{path}.{uuid.uuid4().hex[:6]}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(content)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
@@ -1,31 +1,294 @@
+"""
+无AstrBot的独立运行入口
+
+在一个asyncio进程中复用CloudflareIPOptimizer与CloudflareDDNSUpdater执行
+IP优选 + DDNS更新流程，适合在边缘节点上以单次任务（cron）或守护进程方式运行。
+
+用法:
+    python run_all.py -c config.json              # 执行一次优选和DDNS更新
+    python run_all.py -c config.json --daemon     # 按auto_update_interval循环执行
+    python run_all.py -c config.json --benchmark  # 执行一次并输出耗时与内存统计（JSON）
+
+配置文件为JSON，键与插件配置（_conf_schema.json）相同，未填写的键使用插件默认值；
+cf_token也可以通过环境变量CF_TOKEN提供。
+
+退出码:
+    0 成功（守护进程模式下为收到信号后正常退出）
+    1 未预期的异常
+    2 参数或配置错误
+    3 IP优选测试失败
+    4 DDNS更新失败
+    5 DDNS已更新，但传播验证在超时内未在所有解析器上生效
+    130 单次运行被中断
+"""
 import os
-import subprocess
 import sys
+import json
+import time
+import types
+import signal
+import asyncio
+import logging
+import argparse
+import importlib
+
+_START = time.perf_counter()
+
+PLUGIN_DIR = os.path.dirname(os.path.abspath(__file__))
+PACKAGE_NAME = 'cloudflare_ip_optimizer'
+
+EXIT_OK = 0
+EXIT_ERROR = 1
+EXIT_CONFIG = 2
+EXIT_SCAN_FAILED = 3
+EXIT_DDNS_FAILED = 4
+EXIT_NOT_PROPAGATED = 5
+EXIT_INTERRUPTED = 130
+
+DDNS_REQUIRED = ('cf_token', 'zone_id', 'main_domain')
+
+logger = logging.getLogger(PACKAGE_NAME)
+
+
+def _load_package():
+    """
+    以独立包名加载插件模块（插件模块之间使用相对导入）
+    插件模块只从AstrBot使用logger，这里以标准logging替代，避免加载整个AstrBot框架
+    """
+    if 'astrbot.api' not in sys.modules:
+        api = types.ModuleType('astrbot.api')
+        api.logger = logger
+        astrbot = sys.modules.setdefault('astrbot', types.ModuleType('astrbot'))
+        astrbot.api = api
+        sys.modules['astrbot.api'] = api
+    if PACKAGE_NAME not in sys.modules:
+        package = types.ModuleType(PACKAGE_NAME)
+        package.__path__ = [PLUGIN_DIR]
+        sys.modules[PACKAGE_NAME] = package
+    return _module('cloudflare_optimizer'), _module('tracing')
+
+
+def _module(name: str):
+    """导入插件子模块（DDNS、协调等模块在需要时才导入）"""
+    return importlib.import_module(f'{PACKAGE_NAME}.{name}')
+
+
+def load_config(path: str) -> dict:
+    """读取配置文件，未填写的键使用_conf_schema.json中的默认值"""
+    with open(os.path.join(PLUGIN_DIR, '_conf_schema.json'), 'r', encoding='utf-8') as f:
+        config = {key: item.get('default') for key, item in json.load(f).items()}
+    if path:
+        with open(path, 'r', encoding='utf-8') as f:
+            config.update(json.load(f))
+    if not config.get('cf_token') and os.environ.get('CF_TOKEN'):
+        config['cf_token'] = os.environ['CF_TOKEN']
+    return config
+
+
+class HeadlessRunner:
+    """独立运行的优选 + DDNS流程"""
+
+    def __init__(self, config: dict, optimizer_module, tracing, scan: bool = True, ddns: bool = True):
+        self.config = config
+        self.tracing = tracing
+        self.scan = scan
+        self.optimizer = optimizer_module.CloudflareIPOptimizer(config=config)
+        self.updater = None
+        if ddns:
+            self.updater = _module('cloudflare_ddns').CloudflareDDNSUpdater({
+                'cf_token': config['cf_token'],
+                'zone_id': config['zone_id'],
+                'main_domain': config['main_domain'],
+                'sub_domain': config.get('sub_domain', ''),
+                'record_type': config.get('record_type', 'A'),
+                'result_file': self.optimizer.snapshots.result_path,
+                'verify_resolvers': [
+                    resolver.strip() for resolver in (config.get('verify_resolvers') or '').split(',') if resolver.strip()
+                ],
+                'verify_timeout': config.get('verify_timeout', 300),
+                'selection_metric': config.get('selection_metric', 'auto'),
+                'api_rate_limit': config.get('api_rate_limit', 1200),
+                'api_rate_window': config.get('api_rate_window', 300),
+                'api_burst': config.get('api_burst', 20)
+            })
+        self.leader = None
+        self.last_tracer = None
+
+    def _trace_dir(self) -> str:
+        return os.path.join(self.optimizer._get_cfst_dir(), 'traces')
 
-def run_script(script_name):
-    """运行指定的Python脚本"""
+    async def run_once(self) -> int:
+        """执行一次流程，返回退出码"""
+        with self.tracing.trace_run('headless', self._trace_dir()) as tracer:
+            self.last_tracer = tracer
+            if self.scan:
+                if not await self.optimizer.run_test():
+                    logger.error("❌ IP优选测试失败")
+                    return EXIT_SCAN_FAILED
+                if self.leader is not None:
+                    _module('coordination').publish_snapshot(
+                        self.optimizer.snapshots, self.config['coordination_path'], self.leader.node_id
+                    )
+            if self.updater is None:
+                return EXIT_OK
+            if self.leader is not None and not await self.leader.refresh():
+                logger.warning("扫描期间失去主节点身份，跳过DDNS更新")
+                return EXIT_OK
+            if not await self.updater.update_ddns():
+                logger.error("❌ DDNS更新失败")
+                return EXIT_DDNS_FAILED
+            verification = self.updater.last_verification
+            if verification and not all(result['converged'] for result in verification.values()):
+                logger.warning("DDNS已更新，但部分解析器在超时内未生效")
+                return EXIT_NOT_PROPAGATED
+            logger.info(f"✅ {self.updater.full_domain} -> {self.updater.last_ip}")
+            return EXIT_OK
+
+    async def _follower_sync(self):
+        # 与run_once一样只记录异常，共享存储暂时不可用时守护进程继续运行
+        try:
+            meta = _module('coordination').sync_snapshot(self.optimizer.snapshots, self.config['coordination_path'])
+            holder = await self.leader.current_holder()
+        except Exception as e:
+            logger.exception(f"从节点同步快照异常: {e}")
+            return
+        logger.info(f"当前为从节点（主节点: {holder['node_id'] if holder else '无'}），"
+                    f"{'已导入快照 ' + meta['run_id'] if meta else '无新快照'}，跳过扫描")
+
+    async def run_daemon(self, interval: float) -> int:
+        """按间隔循环执行，收到SIGINT/SIGTERM后中止当前运行（终止扫描器）并退出"""
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            try:
+                loop.add_signal_handler(sig, stop.set)
+            except (NotImplementedError, RuntimeError):
+                # Windows不支持add_signal_handler，依赖KeyboardInterrupt退出
+                pass
+
+        backend = self.config.get('coordination_backend') or 'none'
+        if backend != 'none':
+            coordination = _module('coordination')
+            self.leader = coordination.LeaderElector(
+                coordination.create_lease_backend(backend, self.config.get('coordination_path')),
+                self.config.get('node_id') or None,
+                self.config.get('lease_ttl', 300)
+            )
+            await self.leader.refresh()
+            self.leader.start()
+
+        logger.info(f"守护进程已启动，间隔: {interval}秒")
+        try:
+            while not stop.is_set():
+                if self.leader is not None and not self.leader.is_leader:
+                    await self._follower_sync()
+                else:
+                    run_task = asyncio.create_task(self.run_once())
+                    stop_task = asyncio.create_task(stop.wait())
+                    await asyncio.wait({run_task, stop_task}, return_when=asyncio.FIRST_COMPLETED)
+                    stop_task.cancel()
+                    if not run_task.done():
+                        logger.info("收到停止信号，中止当前运行")
+                        run_task.cancel()
+                        await asyncio.gather(run_task, return_exceptions=True)
+                        break
+                    try:
+                        logger.info(f"本轮运行结束，退出码: {run_task.result()}")
+                    except Exception as e:
+                        logger.exception(f"本轮运行异常: {e}")
+                try:
+                    await asyncio.wait_for(stop.wait(), interval)
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            if self.leader is not None:
+                await self.leader.stop()
+        logger.info("守护进程已退出")
+        return EXIT_OK
+
+
+def _peak_rss_mb():
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux单位为KB，macOS为字节
+    return peak / (1024 * 1024) if sys.platform == 'darwin' else peak / 1024
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description='Cloudflare IP优选 + DDNS 独立运行入口（无需AstrBot）')
+    parser.add_argument('-c', '--config', help='JSON配置文件，键与插件配置相同')
+    parser.add_argument('--daemon', action='store_true', help='守护进程模式，按auto_update_interval循环执行')
+    parser.add_argument('--interval', type=float, help='守护进程模式的执行间隔（秒），覆盖配置中的auto_update_interval')
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument('--scan-only', action='store_true', help='只执行IP优选测试，不更新DDNS')
+    mode.add_argument('--ddns-only', action='store_true', help='只用最新的测试结果更新DDNS，不执行扫描')
+    parser.add_argument('--benchmark', action='store_true', help='执行一次并以JSON输出启动耗时、各阶段耗时和峰值内存')
+    parser.add_argument('-v', '--verbose', action='store_true', help='输出调试日志')
+    return parser.parse_args(argv)
+
+
+def main(argv=None) -> int:
+    args = parse_args(argv)
+    logging.basicConfig(
+        level=logging.DEBUG if args.verbose else logging.INFO,
+        format='%(asctime)s [%(levelname)s] %(message)s'
+    )
+    if args.daemon and args.benchmark:
+        logger.error("--benchmark 不能与 --daemon 同时使用")
+        return EXIT_CONFIG
+
+    try:
+        config = load_config(args.config)
+    except (OSError, ValueError) as e:
+        logger.error(f"读取配置文件失败: {e}")
+        return EXIT_CONFIG
+    ddns = not args.scan_only
+    missing = [key for key in DDNS_REQUIRED if not config.get(key)] if ddns else []
+    if missing:
+        logger.error(f"缺少DDNS必填配置项: {', '.join(missing)}（或使用 --scan-only 只执行优选）")
+        return EXIT_CONFIG
+
+    import_start = time.perf_counter()
+    optimizer_module, tracing = _load_package()
+    construct_start = time.perf_counter()
     try:
-        print(f"正在运行{script_name}...")
-        # 构造完整的脚本路径
-        script_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), script_name)
-        # 运行脚本
-        result = subprocess.run([sys.executable, script_path], check=True)
-        print(f"{script_name}执行成功")
-        return True
-    except subprocess.CalledProcessError as e:
-        print(f"{script_name}执行失败: {e}")
-        return False
+        runner = HeadlessRunner(config, optimizer_module, tracing, scan=not args.ddns_only, ddns=ddns)
+    except ValueError as e:
+        logger.error(f"配置无效: {e}")
+        return EXIT_CONFIG
+    ready = time.perf_counter()
+
+    try:
+        if args.daemon:
+            return asyncio.run(runner.run_daemon(args.interval or config.get('auto_update_interval', 3600)))
+        code = asyncio.run(runner.run_once())
+    except KeyboardInterrupt:
+        logger.warning("运行被中断")
+        return EXIT_INTERRUPTED
     except Exception as e:
-        print(f"运行{script_name}时发生错误: {e}")
-        return False
+        logger.exception(f"运行异常: {e}")
+        return EXIT_ERROR
+
+    if args.benchmark:
+        tracer = runner.last_tracer
+        print(json.dumps({
+            'exit_code': code,
+            'startup_ms': (ready - _START) * 1000,
+            'import_ms': (construct_start - import_start) * 1000,
+            'construct_ms': (ready - construct_start) * 1000,
+            'run_ms': tracer.root.duration * 1000 if tracer else None,
+            'phases': [
+                {'name': phase['name'], 'ms': round(phase['duration'] * 1000, 3)} for phase in tracer.phases()
+            ] if tracer else [],
+            'peak_rss_mb': _peak_rss_mb(),
+            'modules_loaded': len(sys.modules),
+            'trace_file': tracer.path if tracer else None
+        }, ensure_ascii=False, indent=2))
+    return code
+
 
 if __name__ == '__main__':
-    # 先运行main.py
-    main_success = run_script('main.py')
-    
-    # 如果main.py执行成功，再运行ddns.py
-    if main_success:
-        run_script('ddns.py')
-    else:
-        print("main.py执行失败，不继续运行ddns.py")
-        sys.exit(1)
\ No newline at end of file
+    sys.exit(main())
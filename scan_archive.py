@@ -0,0 +1,272 @@
+import os
+import sys
+import json
+import mmap
+import time
+import struct
+import statistics
+import ipaddress
+from array import array
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional, Tuple
+from astrbot.api import logger
+
+# 列名 -> array类型码；IP按128位整数拆为高低两个64位整数存储（IPv4的高位为0）
+COLUMNS = {
+    'ip_hi': 'Q',
+    'ip_lo': 'Q',
+    'latency': 'f',
+    'loss': 'f',
+    'speed': 'f',
+    'colo': 'H',
+    'run': 'I',
+}
+META_FILE_NAME = 'meta.json'
+_MASK64 = (1 << 64) - 1
+
+
+def _split_ip(ip: str) -> Tuple[int, int]:
+    value = int(ipaddress.ip_address(ip))
+    return value >> 64, value & _MASK64
+
+
+def _join_ip(hi: int, lo: int) -> str:
+    value = (hi << 64) | lo
+    return str(ipaddress.IPv4Address(value) if hi == 0 and value <= 0xFFFFFFFF else ipaddress.IPv6Address(value))
+
+
+def _to_float(value: Optional[str]) -> float:
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return float('nan')
+
+
+class ScanArchive:
+    """
+    所有扫描结果的列式二进制归档
+
+    每列一个定长数组文件（只追加），机房代码与运行信息保存在meta.json中：
+    - 行数以meta.json为准，追加时先写列文件再原子更新meta.json，中断的追加会在下次追加时截断
+    - 查询时以mmap映射列文件并转换为memoryview，不把整列读入Python对象
+    - 每次运行追加时记录延迟最低的行，IP获胜次数等查询只需遍历运行表
+    """
+
+    def __init__(self, archive_dir: str):
+        self.archive_dir = archive_dir
+        self.meta = self._load_meta()
+        self._maps: List[mmap.mmap] = []
+        self._views: List[memoryview] = []
+
+    def _load_meta(self) -> Dict:
+        try:
+            with open(os.path.join(self.archive_dir, META_FILE_NAME), 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            if meta.get('byteorder') != sys.byteorder:
+                raise ValueError(f"归档字节序为{meta.get('byteorder')}，与本机不一致")
+            return meta
+        except FileNotFoundError:
+            return {'version': 1, 'byteorder': sys.byteorder, 'rows': 0, 'colos': [], 'runs': []}
+
+    def _column_path(self, name: str) -> str:
+        return os.path.join(self.archive_dir, f"{name}.bin")
+
+    @property
+    def rows(self) -> int:
+        return self.meta['rows']
+
+    @property
+    def runs(self) -> List[List]:
+        """运行表：[运行ID, 完成时间戳, 起始行, 行数, 最优行偏移(无有效行时为-1)]"""
+        return self.meta['runs']
+
+    def append_run(self, run_id: str, rows: List[Dict[str, str]], timestamp: float = None) -> int:
+        """
+        追加一次运行的测速结果
+        :param run_id: 运行ID（快照ID）
+        :param rows: 以表头为键的结果行
+        :param timestamp: 运行完成时间，默认为当前时间
+        :return: 追加的行数
+        """
+        os.makedirs(self.archive_dir, exist_ok=True)
+        colo_ids = {code: index for index, code in enumerate(self.meta['colos'])}
+        run_index = len(self.meta['runs'])
+        columns = {name: array(code) for name, code in COLUMNS.items()}
+        best_offset, best_latency = -1, None
+
+        for row in rows:
+            try:
+                hi, lo = _split_ip(row.get('IP 地址', '').strip())
+            except ValueError:
+                continue
+            latency = _to_float(row.get('平均延迟'))
+            colo = (row.get('地区码') or '').strip() or 'N/A'
+            if colo not in colo_ids:
+                colo_ids[colo] = len(self.meta['colos'])
+                self.meta['colos'].append(colo)
+            if latency == latency and (best_latency is None or latency < best_latency):
+                best_offset, best_latency = len(columns['run']), latency
+            columns['ip_hi'].append(hi)
+            columns['ip_lo'].append(lo)
+            columns['latency'].append(latency)
+            columns['loss'].append(_to_float(row.get('丢包率')))
+            columns['speed'].append(_to_float(row.get('下载速度(MB/s)')))
+            columns['colo'].append(colo_ids[colo])
+            columns['run'].append(run_index)
+
+        start = self.meta['rows']
+        for name, values in columns.items():
+            path = self._column_path(name)
+            with open(path, 'ab') as f:
+                # 截断上次中断追加时留下的多余数据
+                f.truncate(start * values.itemsize)
+                f.write(values.tobytes())
+
+        count = len(columns['run'])
+        self.meta['runs'].append([run_id, timestamp if timestamp is not None else time.time(), start, count, best_offset])
+        self.meta['rows'] = start + count
+        tmp_path = os.path.join(self.archive_dir, f"{META_FILE_NAME}.tmp")
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.meta, f)
+        os.replace(tmp_path, os.path.join(self.archive_dir, META_FILE_NAME))
+        logger.info(f"扫描结果已归档: {run_id} ({count}行，累计{self.meta['rows']}行)")
+        return count
+
+    def column(self, name: str) -> memoryview:
+        """以mmap映射的列（只读memoryview），使用完毕后调用close()释放"""
+        code = COLUMNS[name]
+        length = self.rows * array(code).itemsize
+        if length == 0:
+            return memoryview(array(code))
+        with open(self._column_path(name), 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(mapped)[:length].cast(code)
+        self._maps.append(mapped)
+        self._views.append(view)
+        return view
+
+    def close(self):
+        for view in self._views:
+            view.release()
+        for mapped in self._maps:
+            mapped.close()
+        self._views, self._maps = [], []
+
+    def __enter__(self) -> 'ScanArchive':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _find_rows(self, name: str, value: int) -> List[int]:
+        """在整数列中查找等于value的行（在mmap上做字节搜索，只接受按元素对齐的命中）"""
+        code = COLUMNS[name]
+        itemsize = array(code).itemsize
+        length = self.rows * itemsize
+        if length == 0:
+            return []
+        needle = struct.pack(f"={code}", value)
+        matches = []
+        with open(self._column_path(name), 'rb') as f, \
+                mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            position = mapped.find(needle, 0, length)
+            while position != -1:
+                if position % itemsize == 0:
+                    matches.append(position // itemsize)
+                    position = mapped.find(needle, position + itemsize, length)
+                else:
+                    position = mapped.find(needle, position + 1, length)
+        return matches
+
+    def _runs_since(self, days: Optional[float]) -> List[List]:
+        if not days:
+            return self.runs
+        since = time.time() - days * 86400
+        return [run for run in self.runs if run[1] >= since]
+
+    def overview(self, days: Optional[float] = None, sample_rows: int = 200000) -> Dict:
+        """
+        归档概况与各机房的结果数、延迟中位数
+        :param days: 只统计最近days天的运行，为空时统计全部
+        :param sample_rows: 延迟中位数按运行等间隔抽样估计，抽样行数约为该值（结果数为精确值）
+        """
+        runs = self._runs_since(days)
+        size = sum(os.path.getsize(self._column_path(name)) for name in COLUMNS if os.path.exists(self._column_path(name)))
+        result = {
+            'rows': self.rows,
+            'runs': len(self.runs),
+            'first': self.runs[0][1] if self.runs else None,
+            'last': self.runs[-1][1] if self.runs else None,
+            'bytes': size,
+            'colos': []
+        }
+        if not runs:
+            return result
+        # 运行按时间顺序追加，时间窗口内的行是连续的一段
+        start, end = runs[0][2], runs[-1][2] + runs[-1][3]
+        latency, colo = self.column('latency'), self.column('colo')
+        counts = Counter(colo[start:end])
+        # 按整次运行抽样（行内按延迟排序，逐行等间隔抽样会与行的排列规律重合）
+        step = max(1, -(-(end - start) // sample_rows))
+        groups = defaultdict(list)
+        for _, _, run_start, count, _ in runs[::step]:
+            run_end = run_start + count
+            for value, colo_id in zip(latency[run_start:run_end], colo[run_start:run_end]):
+                if value == value:
+                    groups[colo_id].append(value)
+        result['colos'] = [
+            {
+                'colo': self.meta['colos'][colo_id],
+                'rows': count,
+                'median': statistics.median(groups[colo_id]) if groups.get(colo_id) else None
+            }
+            for colo_id, count in counts.most_common()
+        ]
+        return result
+
+    def colo_daily(self, colo: str, days: float = 30) -> List[Dict]:
+        """某机房每天的延迟中位数（按运行完成时间的本地日期分组）"""
+        if colo not in self.meta['colos']:
+            return []
+        colo_id = self.meta['colos'].index(colo)
+        latency, colo_column = self.column('latency'), self.column('colo')
+        daily = defaultdict(list)
+        for _, timestamp, start, count, _ in self._runs_since(days):
+            end = start + count
+            daily[time.strftime('%Y-%m-%d', time.localtime(timestamp))].extend(
+                value for value, colo_value in zip(latency[start:end], colo_column[start:end])
+                if colo_value == colo_id and value == value
+            )
+        return [
+            {'day': day, 'rows': len(values), 'median': statistics.median(values)}
+            for day, values in sorted(daily.items()) if values
+        ]
+
+    def ip_stats(self, ip: str) -> Dict:
+        """某IP的出现次数、获胜（所在运行中延迟最低）次数与延迟中位数"""
+        hi, lo = _split_ip(ip)
+        ip_hi = self.column('ip_hi')
+        rows = [row for row in self._find_rows('ip_lo', lo) if ip_hi[row] == hi]
+        latency = self.column('latency')
+        latencies = [latency[row] for row in rows if latency[row] == latency[row]]
+        row_set = set(rows)
+        wins = sum(1 for run in self.runs if run[4] >= 0 and run[2] + run[4] in row_set)
+        run_column = self.column('run')
+        return {
+            'ip': ip,
+            'appearances': len(rows),
+            'runs': len({run_column[row] for row in rows}),
+            'wins': wins,
+            'total_runs': len(self.runs),
+            'median': statistics.median(latencies) if latencies else None,
+            'best': min(latencies) if latencies else None
+        }
+
+    def top_winners(self, limit: int = 5, days: Optional[float] = None) -> List[Tuple[str, int]]:
+        """获胜次数最多的IP"""
+        ip_hi, ip_lo = self.column('ip_hi'), self.column('ip_lo')
+        wins = Counter(
+            (ip_hi[start + best], ip_lo[start + best])
+            for _, _, start, _, best in self._runs_since(days) if best >= 0
+        )
+        return [(_join_ip(hi, lo), count) for (hi, lo), count in wins.most_common(limit)]
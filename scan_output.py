@@ -0,0 +1,135 @@
+import os
+import re
+import gzip
+import time
+from collections import deque
+from typing import Deque, List, Optional
+from astrbot.api import logger
+
+# 扫描器输出中表示测试完成的标志
+SUCCESS_MARKERS = ("延迟测速完成", "完整测速结果已写入", "测试完成", "完成测试", "测试结束")
+# 错误行关键字（英文按小写匹配）
+ERROR_KEYWORDS = ("error", "错误", "failed", "失败", "exception")
+# 行分隔符：扫描器用\r原地刷新进度条，与\n同样视为一行结束
+LINE_SEPARATOR = re.compile(rb'[\r\n]')
+
+
+class ScanOutputMonitor:
+    """
+    扫描器输出的单次流式处理
+
+    每行输出只处理一次：放入固定长度的环形缓冲区（用于失败诊断），增量匹配成功标志
+    与错误关键字，按时间间隔限流写调试日志，并可选地把完整输出写入gzip压缩的日志文件。
+    输出按块读取后由feed_chunk按\r与\n切分成行，未结束的行缓存到下一块，超长时强制切分。
+    无论扫描运行多久，内存占用与日志量都有上限。
+    """
+
+    def __init__(self, tail_lines: int = 50, error_lines: int = 5, log_interval: float = 5.0,
+                 max_line_length: int = 1024, spool_path: Optional[str] = None):
+        """
+        :param tail_lines: 环形缓冲区保留的最近行数
+        :param error_lines: 保留的最近错误行数
+        :param log_interval: 调试日志最少间隔（秒），间隔内的其他行只计数
+        :param max_line_length: 缓冲区中单行保留的最大字符数
+        :param spool_path: 完整输出的gzip日志路径，为空时不保存
+        """
+        self.tail: Deque[str] = deque(maxlen=tail_lines)
+        self.errors: Deque[str] = deque(maxlen=error_lines)
+        self.log_interval = log_interval
+        self.max_line_length = max_line_length
+        self.line_count = 0
+        self.byte_count = 0
+        self.success_line: Optional[str] = None
+        self.spool_path = spool_path
+        self._spool = None
+        self._last_log = 0.0
+        self._suppressed = 0
+        self._partial = b''
+        if spool_path:
+            try:
+                os.makedirs(os.path.dirname(spool_path), exist_ok=True)
+                self._spool = gzip.open(spool_path, 'wb', compresslevel=6)
+            except OSError as e:
+                logger.warning(f"无法创建扫描输出日志 {spool_path}: {e}")
+                self.spool_path = None
+
+    @property
+    def success_found(self) -> bool:
+        return self.success_line is not None
+
+    def feed(self, raw_line: bytes) -> str:
+        """
+        处理一行原始输出
+        :param raw_line: 扫描器输出的一行（字节）
+        :return: 解码并去除首尾空白后的行
+        """
+        self.line_count += 1
+        self.byte_count += len(raw_line)
+        if self._spool is not None:
+            self._spool.write(raw_line)
+
+        line = raw_line.decode('utf-8', errors='replace').strip()
+        if len(line) > self.max_line_length:
+            line = line[:self.max_line_length] + '…'
+        self.tail.append(line)
+
+        if self.success_line is None and any(marker in line for marker in SUCCESS_MARKERS):
+            self.success_line = line
+        lowered = line.lower()
+        if any(keyword in lowered for keyword in ERROR_KEYWORDS):
+            self.errors.append(line)
+
+        now = time.monotonic()
+        if now - self._last_log >= self.log_interval:
+            suffix = f" (此前省略{self._suppressed}行)" if self._suppressed else ""
+            logger.debug(f"进程输出: {line}{suffix}")
+            self._last_log = now
+            self._suppressed = 0
+        else:
+            self._suppressed += 1
+        return line
+
+    def feed_chunk(self, chunk: bytes) -> List[str]:
+        """
+        处理一块原始输出，按\r或\n切分出完整的行逐行处理
+        :param chunk: 从扫描器输出读取的字节块
+        :return: 本块中处理的行（解码并去除首尾空白，不含空行）
+        """
+        parts = LINE_SEPARATOR.split(self._partial + chunk)
+        self._partial = parts.pop()
+        # 长时间没有行结束符时按字节上限强制切分，避免缓存无限增长
+        limit = self.max_line_length * 4
+        if len(self._partial) > limit:
+            parts.append(self._partial)
+            self._partial = b''
+        return [self.feed(part + b'\n') for part in parts if part.strip()]
+
+    def flush(self) -> List[str]:
+        """输出结束时处理缓存中最后一行（没有行结束符）"""
+        partial, self._partial = self._partial, b''
+        return [self.feed(partial + b'\n')] if partial.strip() else []
+
+    def close(self):
+        """结束处理，关闭gzip日志"""
+        if self._spool is not None:
+            self._spool.close()
+            self._spool = None
+
+    def summary(self) -> List[str]:
+        """失败诊断：有错误行时返回最近的错误行，否则返回最后10行输出"""
+        if self.errors:
+            return list(self.errors)
+        return list(self.tail)[-10:]
+
+
+def prune_spool_dir(spool_dir: str, retention: int):
+    """只保留最新的retention个扫描输出日志"""
+    try:
+        names = sorted(name for name in os.listdir(spool_dir) if name.endswith('.log.gz'))
+    except OSError:
+        return
+    for name in names[:max(0, len(names) - retention)]:
+        try:
+            os.remove(os.path.join(spool_dir, name))
+        except OSError:
+            pass
@@ -0,0 +1,224 @@
+import os
+import sys
+import json
+import time
+import uuid
+import threading
+import functools
+import contextvars
+from contextlib import contextmanager
+from typing import Any, Dict, List, Optional
+from astrbot.api import logger
+
+_current_tracer: contextvars.ContextVar = contextvars.ContextVar('cf_tracer', default=None)
+_current_span: contextvars.ContextVar = contextvars.ContextVar('cf_span', default=None)
+
+
+class Span:
+    """一个计时区间，可嵌套子区间"""
+
+    def __init__(self, name: str, parent: Optional['Span'] = None, **attrs):
+        self.name = name
+        self.attrs = attrs
+        self.children: List['Span'] = []
+        self.start = time.perf_counter()
+        self.end: Optional[float] = None
+        if parent is not None:
+            parent.children.append(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.end if self.end is not None else time.perf_counter()) - self.start
+
+    def set(self, **attrs):
+        """附加属性"""
+        self.attrs.update(attrs)
+
+    def finish(self):
+        if self.end is None:
+            self.end = time.perf_counter()
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            'name': self.name,
+            'start_ms': round((self.start - origin) * 1000, 3),
+            'duration_ms': round(self.duration * 1000, 3),
+            'attrs': self.attrs,
+            'children': [child.to_dict(origin) for child in self.children]
+        }
+
+
+class Tracer:
+    """一次流水线运行的追踪记录"""
+
+    def __init__(self, name: str):
+        self.root = Span(name)
+        self.started_at = time.time()
+        # 追踪ID：启动时间（毫秒）加随机后缀，同名追踪在同一秒内运行也不会覆盖
+        millis = int(self.started_at * 1000) % 1000
+        self.trace_id = (f"{time.strftime('%Y%m%d-%H%M%S', time.localtime(self.started_at))}"
+                         f"-{millis:03d}-{uuid.uuid4().hex[:6]}")
+        self.path: Optional[str] = None
+
+    def phases(self) -> List[Dict[str, Any]]:
+        """展开所有区间，按耗时降序返回（名称带层级路径）"""
+        phases = []
+
+        def walk(span: Span, prefix: str):
+            path = f"{prefix}/{span.name}" if prefix else span.name
+            phases.append({'name': path, 'duration': span.duration, 'attrs': span.attrs})
+            for child in span.children:
+                walk(child, path)
+
+        for child in self.root.children:
+            walk(child, '')
+        return sorted(phases, key=lambda phase: phase['duration'], reverse=True)
+
+    def save(self, trace_dir: str, keep: int = 20) -> str:
+        """写入JSON追踪文件，并只保留最近keep个"""
+        os.makedirs(trace_dir, exist_ok=True)
+        name = f"trace-{self.trace_id}-{self.root.name}.json"
+        self.path = os.path.join(trace_dir, name)
+        data = {'trace_id': self.trace_id, 'started_at': self.started_at, **self.root.to_dict(self.root.start)}
+        with open(self.path, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
+        traces = sorted(entry for entry in os.listdir(trace_dir) if entry.startswith('trace-'))
+        for old in traces[:-keep]:
+            try:
+                os.unlink(os.path.join(trace_dir, old))
+            except OSError:
+                pass
+        return self.path
+
+
+@contextmanager
+def trace_run(name: str, trace_dir: str):
+    """
+    开始一次追踪，期间通过span()创建的区间都记录到该追踪中，结束时写入trace_dir
+    已处于追踪中时直接复用外层追踪（作为一个子区间）
+    """
+    if _current_tracer.get() is not None:
+        with span(name):
+            yield _current_tracer.get()
+        return
+
+    tracer = Tracer(name)
+    tracer_token = _current_tracer.set(tracer)
+    span_token = _current_span.set(tracer.root)
+    try:
+        yield tracer
+    finally:
+        tracer.root.finish()
+        _current_span.reset(span_token)
+        _current_tracer.reset(tracer_token)
+        try:
+            path = tracer.save(trace_dir)
+            logger.info(f"追踪文件已写入: {path} (总耗时{tracer.root.duration:.1f}秒)")
+        except OSError as e:
+            logger.warning(f"写入追踪文件失败: {e}")
+
+
+@contextmanager
+def span(name: str, **attrs):
+    """在当前追踪中记录一个嵌套区间；未处于追踪中时不做任何事"""
+    parent = _current_span.get()
+    if parent is None:
+        yield None
+        return
+    current = Span(name, parent, **attrs)
+    token = _current_span.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.set(error=type(e).__name__)
+        raise
+    finally:
+        current.finish()
+        _current_span.reset(token)
+
+
+def start_span(name: str, **attrs) -> Optional[Span]:
+    """手动开始一个区间（不改变当前区间），需要调用finish()结束"""
+    parent = _current_span.get()
+    return Span(name, parent, **attrs) if parent is not None else None
+
+
+def traced(name: str):
+    """异步函数装饰器：把整个调用记录为一个区间"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class SamplingProfiler:
+    """
+    采样分析器
+
+    在后台线程中按固定间隔采集目标线程的调用栈，统计每个函数作为栈顶（自身）
+    和出现在栈中（累计）的样本数，开销与被分析代码的调用次数无关。
+    目标线程通常是事件循环线程，栈顶位于selectors模块时事件循环正在等待I/O，
+    这类样本只计入idle_samples，不参与热点统计，百分比按非空闲样本计算。
+    """
+
+    def __init__(self, interval: float = 0.005, thread_id: int = None):
+        self.interval = interval
+        self.thread_id = thread_id if thread_id is not None else threading.get_ident()
+        self.samples = 0
+        self.idle_samples = 0
+        self.self_counts: Dict[str, int] = {}
+        self.total_counts: Dict[str, int] = {}
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    @staticmethod
+    def _label(frame) -> str:
+        code = frame.f_code
+        return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+    def _sample(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            self.samples += 1
+            if os.path.basename(frame.f_code.co_filename) == 'selectors.py':
+                self.idle_samples += 1
+                continue
+            label = self._label(frame)
+            self.self_counts[label] = self.self_counts.get(label, 0) + 1
+            seen = set()
+            while frame is not None:
+                label = self._label(frame)
+                if label not in seen:
+                    seen.add(label)
+                    self.total_counts[label] = self.total_counts.get(label, 0) + 1
+                frame = frame.f_back
+
+    def start(self):
+        self._thread = threading.Thread(target=self._sample, name='cf-sampling-profiler', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+
+    @property
+    def busy_samples(self) -> int:
+        """非空闲样本数"""
+        return self.samples - self.idle_samples
+
+    def top(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """按自身样本数降序返回热点函数（百分比相对非空闲样本）"""
+        ranked = sorted(self.self_counts.items(), key=lambda item: item[1], reverse=True)[:limit]
+        busy = self.busy_samples
+        return [{
+            'function': label,
+            'self': count,
+            'total': self.total_counts.get(label, 0),
+            'self_pct': count * 100 / busy if busy else 0.0
+        } for label, count in ranked]